@@ -54,9 +54,7 @@ class A2C_ACKTR():
             self.actor_critic.zero_grad()
             pg_fisher_loss = -action_log_probs.mean()
 
-            value_noise = torch.randn(values.size())
-            if values.is_cuda:
-                value_noise = value_noise.cuda()
+            value_noise = torch.randn(values.size(), device=values.device)
 
             sample_values = values + value_noise
             vf_fisher_loss = -(values - sample_values.detach()).pow(2).mean()
@@ -38,10 +38,7 @@ def compute_cov_a(a, classname, layer_info, fast_cnn):
             a = _extract_patches(a, *layer_info)
             a = a.view(-1, a.size(-1)).div_(a.size(1)).div_(a.size(2))
     elif classname == 'AddBias':
-        is_cuda = a.is_cuda
-        a = torch.ones(a.size(0), 1)
-        if is_cuda:
-            a = a.cuda()
+        a = torch.ones(a.size(0), 1, device=a.device)
 
     return a.t() @ (a / batch_size)
 
@@ -1,8 +1,12 @@
+import time
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 
+from a2c_ppo_acktr.model import GetMask, UpdateC, trace_inference, fold_batch_norm, quantize_for_inference
+
 def torch_end_point_norm(x,dim):
     x_max  = x.max (dim=dim,keepdim=True)[0].expand(x.size())
     x_min  = x.min (dim=dim,keepdim=True)[0].expand(x.size())
@@ -19,7 +23,11 @@ class MEGA():
                  empty_value,
                  G_skip,
                  clip_ir,
-                 hash_type):
+                 hash_type,
+                 traced_inference=False,
+                 folded_inference=False,
+                 quantized_inference=False,
+                 neighborhood_tradeoff_interval=None):
 
         self.direct_control_model = direct_control_model
         self.latent_control_model = latent_control_model
@@ -40,9 +48,37 @@ class MEGA():
 
         self.empty_intrinsic_reward = {}
 
+        '''get_mask and update_C traced per batch size, dropped whenever the models are updated'''
+        self.traced_inference = traced_inference
+        self.traced = {}
+
+        '''BatchNorm-folded twins of the control models for the per-step path, dropped whenever the models are updated'''
+        self.folded_inference = folded_inference
+        self.inference_models = None
+
+        '''int8 CPU twins of the control models for the per-step path, calibrated
+        on the last mini-batch sampled from the replay buffer, dropped whenever the
+        models are updated. Until the first update there is nothing to calibrate on,
+        so the fp32 models are used'''
+        self.quantized_inference = quantized_inference
+        self.calibration_sampled = None
+        self.inference_device = None
+
+        '''the neighborhood trade-off evaluates the dense model as well, so it is
+        only reported every neighborhood_tradeoff_interval updates, if given'''
+        self.neighborhood_tradeoff_interval = neighborhood_tradeoff_interval
+        self.num_updates = 0
+
     def update(self, prioritized_replay_buffer):
+        '''besides the losses, reports the time of the update and, on cuda, its
+        peak memory, the trade-off of LatentControlModel.checkpoint_rows'''
         epoch_loss = {}
 
+        device = next(self.direct_control_model.parameters()).device
+        if device.type in ['cuda']:
+            torch.cuda.reset_peak_memory_stats(device)
+        time_start = time.time()
+
         e = 0
         while True:
 
@@ -56,74 +92,268 @@ class MEGA():
                 batch_size = self.mini_batch_size,
             )
 
-            '''
-            update direct_control model
-            '''
+            epoch_loss, loss_transition = self.update_batch(sampled)
+
+            if (loss_transition is not None) and (prioritized_replay_buffer.mode=='priority'):
+                prioritized_replay_buffer.update_priorities(
+                    idxes = idxes,
+                    priorities = loss_transition.cpu().numpy(),
+                )
+
+            e += 1
+
+        if (self.latent_control_model is not None) and (self.latent_control_model.neighborhood_radius is not None) \
+                and (self.neighborhood_tradeoff_interval is not None) and (self.num_updates%self.neighborhood_tradeoff_interval==0):
+            epoch_loss.update(self.get_neighborhood_tradeoff(sampled))
+        self.num_updates += 1
+
+        epoch_loss = {name: loss.item() for name, loss in epoch_loss.items()}
+        epoch_loss['control_model_update_seconds'] = time.time()-time_start
+        if device.type in ['cuda']:
+            epoch_loss['control_model_peak_memory_mb'] = torch.cuda.max_memory_allocated(device)/1024.0**2
+
+        if self.quantized_inference:
+            '''quantize right away, out of the update time, so that the int8 deltas are reported with the losses'''
+            self.inference_models, quantization_deltas = self.quantize_inference_models()
+            self.inference_device = torch.device('cpu')
+            epoch_loss.update({name: delta.item() for name, delta in quantization_deltas.items()})
+
+        return epoch_loss
+
+    def get_neighborhood_tradeoff(self, sampled):
+        '''what restricting latent_control_model to its neighborhood_radius
+        costs on sampled: its loss_transition with and without the
+        restriction, and the mean absolute difference of G updated from M'''
+        latent_control_model = self.latent_control_model
+        last_states = sampled['states']
+        now_states = sampled['skipped_next_states'] if self.G_skip>1 else sampled['next_states']
+
+        self.direct_control_model.eval()
+        latent_control_model.eval()
+        tradeoff = {}
+        G = {}
+        with torch.no_grad():
+            M = self.direct_control_model.get_mask(sampled['next_states'][:,-1:])
+            try:
+                for name, is_neighborhood in [('neighborhood', True), ('dense', False)]:
+                    latent_control_model.is_neighborhood = is_neighborhood
+                    predicted_now_states, now_states_target, _, _ = latent_control_model.get_predicted_now_states(
+                        last_states    = last_states,
+                        now_states     = now_states,
+                        onehot_actions = sampled['actions'],
+                    )
+                    tradeoff['loss_transition_{}'.format(name)] = F.mse_loss(predicted_now_states, now_states_target)
+                    G[name] = latent_control_model.update_C_deterministic(M, last_states, sampled['next_states'][:,-1:], sampled['actions'])
+            finally:
+                latent_control_model.is_neighborhood = True
+        tradeoff['neighborhood_G_delta'] = (G['neighborhood']-G['dense']).abs().mean()
+        return tradeoff
+
+    def update_batch(self, sampled):
+        """Take one optimization step of the control models on a batch of
+        transitions, sampled from the replay buffer or from recorded trajectories.
+        Returns the detached losses and the per-sample loss_transition (None
+        without latent_control_model), to be used as priorities."""
+        epoch_loss = {}
+        self.traced = {}
+        self.inference_models = None
+        if self.quantized_inference:
+            self.calibration_sampled = sampled
+
+        '''
+        update direct_control model
+        '''
+        '''reset grad'''
+        self.optimizer_direct_control_model.zero_grad()
+        '''forward'''
+        self.direct_control_model.train()
+        loss_action, loss_action_each, loss_ent_direct = self.direct_control_model(
+            last_states   = sampled['states'][:,-1:],
+            now_states    = sampled['next_states'],
+            action_lables = sampled['actions'].view(-1) if sampled['actions'].dtype==torch.long else sampled['actions'].nonzero()[:,1],
+        )
+
+        '''integrate losses'''
+        loss_direct_control_model = loss_action + loss_action_each + 0.001*loss_ent_direct
+        '''backward'''
+        loss_direct_control_model.backward()
+        '''optimize'''
+        self.optimizer_direct_control_model.step()
+
+        epoch_loss['loss_action'] = loss_action.detach()
+        epoch_loss['loss_action_each'] = loss_action_each.detach()
+        epoch_loss['loss_ent_direct'] = loss_ent_direct.detach()
+        epoch_loss['loss_direct_control_model'] = loss_direct_control_model.detach()
+
+        '''
+        update latent_control model
+        '''
+        loss_transition_batch = None
+        if self.latent_control_model is not None:
             '''reset grad'''
-            self.optimizer_direct_control_model.zero_grad()
-            '''forward'''
-            self.direct_control_model.train()
-            loss_action, loss_action_each, loss_ent_direct = self.direct_control_model(
-                last_states   = sampled['states'][:,-1:],
-                now_states    = sampled['next_states'],
-                action_lables = sampled['actions'].nonzero()[:,1],
-            )
+            self.optimizer_latent_control_model.zero_grad()
+            self.latent_control_model.train()
+            now_states = sampled['skipped_next_states'] if self.G_skip>1 else sampled['next_states']
+
+            '''forward and backward in micro batches whose activations fit
+            latent_control_model.memory_budget, gradients accumulate weighted
+            by the share of the batch in each micro batch'''
+            batch_size = sampled['states'].size()[0]
+            micro_batch_size = self.latent_control_model.get_micro_batch_size(batch_size)
+            for start in range(0, batch_size, micro_batch_size):
+                micro_batch = slice(start, start+micro_batch_size)
+                weight = (min(start+micro_batch_size, batch_size)-start)/batch_size
 
-            '''integrate losses'''
-            loss_direct_control_model = loss_action + loss_action_each + 0.001*loss_ent_direct
-            '''backward'''
-            loss_direct_control_model.backward()
-            '''optimize'''
-            self.optimizer_direct_control_model.step()
-
-            '''
-            update latent_control model
-            '''
-            if self.latent_control_model is not None:
-                '''reset grad'''
-                self.optimizer_latent_control_model.zero_grad()
                 '''forward'''
-                self.latent_control_model.train()
                 loss_transition, loss_transition_each, loss_ent_latent = self.latent_control_model(
-                    last_states    = sampled['states'],
-                    now_states     = sampled['skipped_next_states'] if self.G_skip>1 else sampled['next_states'],
-                    onehot_actions = sampled['actions'],
+                    last_states    = sampled['states'][micro_batch],
+                    now_states     = now_states[micro_batch],
+                    onehot_actions = sampled['actions'][micro_batch],
                 )
 
-                if prioritized_replay_buffer.mode=='priority':
-                    prioritized_replay_buffer.update_priorities(
-                        idxes = idxes,
-                        priorities = loss_transition.detach().cpu().numpy(),
-                    )
                 '''(batch_size) -> (1)'''
                 loss_transition = loss_transition.mean(dim=0,keepdim=False)
                 '''integrate losses'''
                 loss_latent_control_model = loss_transition + loss_transition_each + 0.001*loss_ent_latent
                 '''backward'''
-                loss_latent_control_model.backward()
-                '''optimize'''
-                self.optimizer_latent_control_model.step()
+                (loss_latent_control_model*weight).backward()
 
-            e += 1
+                for name, loss in [
+                    ('loss_transition', loss_transition),
+                    ('loss_transition_each', loss_transition_each),
+                    ('loss_ent_latent', loss_ent_latent),
+                    ('loss_latent_control_model', loss_latent_control_model),
+                ]:
+                    epoch_loss[name] = epoch_loss.get(name, 0.0) + loss.detach()*weight
 
-        epoch_loss['loss_action'] = loss_action.item()
-        epoch_loss['loss_action_each'] = loss_action_each.item()
-        epoch_loss['loss_ent_direct'] = loss_ent_direct.item()
-        epoch_loss['loss_direct_control_model'] = loss_direct_control_model.item()
-        if self.latent_control_model is not None:
-            epoch_loss['loss_transition'] = loss_transition.item()
-            epoch_loss['loss_transition_each'] = loss_transition_each.item()
-            epoch_loss['loss_ent_latent'] = loss_ent_latent.item()
-            epoch_loss['loss_latent_control_model'] = loss_latent_control_model.item()
+            '''optimize'''
+            self.optimizer_latent_control_model.step()
+
+            loss_transition_batch = epoch_loss['loss_transition']
+
+        return epoch_loss, loss_transition_batch
+
+
+    def get_inference_models(self):
+        '''direct_control_model and latent_control_model for the per-step
+        path, their BatchNorm-folded twins if folded_inference, their int8
+        twins if quantized_inference. self.inference_device is the device
+        inputs have to be moved to for them, None for the device of the models'''
+        if self.quantized_inference and (self.calibration_sampled is not None):
+            if self.inference_models is None:
+                self.inference_models, _ = self.quantize_inference_models()
+                self.inference_device = torch.device('cpu')
+            return self.inference_models
+        self.inference_device = None
+        if not self.folded_inference:
+            return self.direct_control_model, self.latent_control_model
+        if self.inference_models is None:
+            self.inference_models = (
+                fold_batch_norm(self.direct_control_model),
+                None if self.latent_control_model is None else fold_batch_norm(self.latent_control_model),
+            )
+        return self.inference_models
 
-        return epoch_loss
+    def quantize_inference_models(self):
+        '''int8 twins of the control models calibrated on self.calibration_sampled,
+        and how far the M and G maps of the twins are from the fp32 ones on it'''
+        sampled = self.calibration_sampled
+        now_states = sampled['next_states'][:,-1:]
+        last_states = sampled['states']
 
+        self.direct_control_model.eval()
+        with torch.no_grad():
+            M = self.direct_control_model.get_mask(now_states)
+        direct_control_model = quantize_for_inference(
+            model = self.direct_control_model,
+            conv_branches = ['Gamma_conv'],
+            calibrate = lambda model: model.get_mask(now_states.cpu()),
+        )
+        with torch.no_grad():
+            quantized_M = direct_control_model.get_mask(now_states.cpu())
+        quantization_deltas = {
+            'int8_M_delta_max': (quantized_M-M.cpu()).abs().max(),
+            'int8_M_delta_mean': (quantized_M-M.cpu()).abs().mean(),
+        }
+
+        latent_control_model = None
+        if self.latent_control_model is not None:
+            '''G starts as M, see generate_direct_and_latent_control_map'''
+            self.latent_control_model.eval()
+            with torch.no_grad():
+                G = self.latent_control_model.update_C_deterministic(M, last_states, now_states, sampled['actions'])
+            latent_control_model = quantize_for_inference(
+                model = self.latent_control_model,
+                conv_branches = ['Gamma_conv'],
+                calibrate = lambda model: model.update_C_deterministic(M.cpu(), last_states.cpu(), now_states.cpu(), sampled['actions'].cpu()),
+            )
+            with torch.no_grad():
+                quantized_G = latent_control_model.update_C_deterministic(M.cpu(), last_states.cpu(), now_states.cpu(), sampled['actions'].cpu())
+            quantization_deltas['int8_G_delta_max'] = (quantized_G-G.cpu()).abs().max()
+            quantization_deltas['int8_G_delta_mean'] = (quantized_G-G.cpu()).abs().mean()
+
+        return (direct_control_model, latent_control_model), quantization_deltas
+
+    def get_mask(self, now_states):
+        '''direct_control_model.get_mask, through the traced graph if traced_inference'''
+        direct_control_model, _ = self.get_inference_models()
+        if self.inference_device is not None:
+            return self.get_mask_on(direct_control_model, now_states.to(self.inference_device)).to(now_states.device)
+        return self.get_mask_on(direct_control_model, now_states)
+
+    def get_mask_on(self, direct_control_model, now_states):
+        if not self.traced_inference:
+            return direct_control_model.get_mask(
+                now_states = now_states,
+            )
+        key = ('get_mask', now_states.size()[0])
+        if key not in self.traced.keys():
+            '''build the coordinates outside of the trace'''
+            direct_control_model.get_mask(now_states)
+            self.traced[key] = trace_inference(GetMask(direct_control_model), (now_states,))
+        return self.traced[key](now_states)
+
+    def update_C(self, C, last_states, now_states, onehot_actions):
+        '''latent_control_model.update_C, through the traced graph if traced_inference'''
+        _, latent_control_model = self.get_inference_models()
+        if self.inference_device is not None:
+            '''noise is added on the device of the fp32 model, where its noise masks live'''
+            last_states, now_states = self.latent_control_model.add_update_C_noise(
+                last_states = last_states,
+                now_states = now_states,
+            )
+            return self.update_C_deterministic_on(
+                latent_control_model,
+                *[x.to(self.inference_device) for x in [C, last_states, now_states, onehot_actions]]
+            ).to(C.device)
+        if not self.traced_inference:
+            return latent_control_model.update_C(
+                C = C,
+                last_states    = last_states,
+                now_states     = now_states,
+                onehot_actions = onehot_actions,
+            )
+        last_states, now_states = latent_control_model.add_update_C_noise(
+            last_states = last_states,
+            now_states = now_states,
+        )
+        return self.update_C_deterministic_on(latent_control_model, C, last_states, now_states, onehot_actions)
+
+    def update_C_deterministic_on(self, latent_control_model, C, last_states, now_states, onehot_actions):
+        if not self.traced_inference:
+            return latent_control_model.update_C_deterministic(C, last_states, now_states, onehot_actions)
+        key = ('update_C', last_states.size()[0])
+        if key not in self.traced.keys():
+            '''build the coordinates outside of the trace'''
+            latent_control_model.update_C_deterministic(C, last_states, now_states, onehot_actions)
+            self.traced[key] = trace_inference(UpdateC(latent_control_model), (C, last_states, now_states, onehot_actions))
+        return self.traced[key](C, last_states, now_states, onehot_actions)
 
     def generate_direct_and_latent_control_map(self, last_states, now_states, onehot_actions, G, masks, direct_control_mask):
 
         '''get M'''
         self.direct_control_model.eval()
-        M = self.direct_control_model.get_mask(
+        M = self.get_mask(
             now_states = now_states,
         ).detach()
         M = direct_control_mask.mask(M)
@@ -137,7 +367,7 @@ class MEGA():
             else:
                 new_uG = G * masks
                 self.latent_control_model.eval()
-                new_uG = self.latent_control_model.update_C(
+                new_uG = self.update_C(
                     C = new_uG,
                     last_states    = last_states,
                     now_states     = now_states,
@@ -235,6 +465,15 @@ class MEGA():
 
         return intrinsic_reward, map_to_use, x_mean_to_norm
 
+    def clear_batch_caches(self):
+        '''called when num_processes changes'''
+        self.empty_intrinsic_reward = {}
+        self.traced = {}
+        self.inference_models = None
+        self.direct_control_model.clear_batch_caches()
+        if self.latent_control_model is not None:
+            self.latent_control_model.clear_batch_caches()
+
     def generate_empty_intrinsic_reward(self, extrinsic_reward):
         if extrinsic_reward.size()[0] not in self.empty_intrinsic_reward.keys():
             self.empty_intrinsic_reward[extrinsic_reward.size()[0]] = extrinsic_reward.clone().fill_(self.empty_value)
@@ -3,6 +3,42 @@ import argparse
 import torch
 
 
+def conv_out_size(size, kernel_size, stride):
+    return (size-kernel_size)//stride+1
+
+def get_conved_size(size_grid, model_structure):
+    '''
+    size of a cell after the convs of model_structure,
+    None if the deconvs cannot map it back to size_grid exactly
+    '''
+    size = size_grid
+    for name in ['conv_0','conv_1']:
+        if name in model_structure.keys():
+            _, _, kernel_size, stride = model_structure[name]
+            if (size<kernel_size) or ((size-kernel_size)%stride!=0):
+                return None
+            size = conv_out_size(size, kernel_size, stride)
+    return size
+
+def get_cut_obs_size(crop_obs, num_grid, model_structure):
+    '''
+    largest square obs_size that fits in the cropped region, is divisible by
+    num_grid and keeps the conv/deconv geometry of model_structure exact
+    '''
+    obs_size = min(
+        crop_obs['h'][1]-crop_obs['h'][0],
+        crop_obs['w'][1]-crop_obs['w'][0],
+    )
+    while obs_size>0:
+        if num_grid is None:
+            return obs_size
+        if obs_size%num_grid==0:
+            if all([get_conved_size(int(obs_size/num_grid), model_structure[name]) is not None for name in model_structure.keys()]):
+                return obs_size
+        obs_size -= 1
+    raise Exception('# ERROR: no obs_size fits crop_obs {} with num_grid {}'.format(crop_obs, num_grid))
+
+
 def get_args():
     parser = argparse.ArgumentParser(description='RL')
     parser.add_argument('--algo', default='a2c',
@@ -31,6 +67,18 @@ def get_args():
                         help="sets flags for determinism when using CUDA (potentially slow!)")
     parser.add_argument('--num-processes', type=int, default=16,
                         help='how many training CPU processes to use (default: 16)')
+    parser.add_argument('--num-processes-file', default=None,
+                        help='file holding the number of env workers, re-read between updates so that workers can be added or removed while training (default: None)')
+    parser.add_argument('--vec-env', type=str, default='subproc',
+                        help='subproc: envs in worker processes; thread: envs in a thread pool of the main process; auto: pick by measuring the step cost of the env against the pipe cost of its obs (default: subproc)')
+    parser.add_argument('--num-envs-per-worker', type=int, default=1,
+                        help='how many envs each CPU process hosts and steps in a loop (default: 1)')
+    parser.add_argument('--warm-start', action='store_true', default=False,
+                        help='fork env workers from a forkserver that has the heavy imports preloaded')
+    parser.add_argument('--async-envs-k', type=int, default=None,
+                        help='step the envs asynchronously, acting on the first k of them that are ready, so that slow envs do not stall the others. Only supports --train-with-reward ex: the MEGA intrinsic reward is not computed on the ready subsets of envs (default: None, synchronous)')
+    parser.add_argument('--async-envs-timeout', type=float, default=None,
+                        help='with --async-envs-k, act on the ready envs once this many seconds have passed, even if fewer than k are ready (default: None)')
     parser.add_argument('--num-steps', type=int, default=5,
                         help='number of forward steps in A2C (default: 5)')
     parser.add_argument('--ppo-epoch', type=int, default=4,
@@ -55,6 +103,12 @@ def get_args():
                         help='directory to save agent logs (default: /tmp/gym)')
     parser.add_argument('--no-cuda', action='store_true', default=False,
                         help='disables CUDA training')
+    parser.add_argument('--device', type=str, default=None,
+                        help='torch device to run everything on, e.g. cpu, cuda:1 (default: cuda:0 if CUDA is available and not --no-cuda, cpu otherwise)')
+    parser.add_argument('--num-torch-threads', type=int, default=None,
+                        help='intra-op threads of torch (default: 1 on cuda, the cores not taken by env workers on cpu)')
+    parser.add_argument('--num-torch-interop-threads', type=int, default=None,
+                        help='inter-op threads of torch (default: 1 on cuda, a quarter of the intra-op threads on cpu)')
     parser.add_argument('--add-timestep', action='store_true', default=False,
                         help='add timestep to observations')
     parser.add_argument('--recurrent-policy', action='store_true', default=False,
@@ -103,9 +157,67 @@ def get_args():
                          help='if eval')
     parser.add_argument('--eval-steps', type=int, default=10,
                          help='num steps to evaluate')
+    parser.add_argument('--record-trajectory-dir', default=None,
+                         help='record the frames, actions, rewards and dones of the training envs into memory-mapped files in this dir')
+    parser.add_argument('--record-trajectory-steps', type=int, default=10000,
+                         help='number of steps of all training envs to record with --record-trajectory-dir')
+    parser.add_argument('--replay-trajectory-dir', default=None,
+                         help='replay the trajectory recorded in this dir instead of running the emulators, for deterministic profiling')
+    parser.add_argument('--num-bootup-updates', type=int, default=600,
+                         help='number of updates acting randomly without updating the policy, while the control models are trained')
+    parser.add_argument('--pretrained-control-models-dir', default=None,
+                         help='dir of control models pretrained by pretrain_control_models.py, restored when starting a run')
+    parser.add_argument('--pretrain-trajectory-dirs', type=str, nargs='*', default=[],
+                         help='dirs of trajectories recorded with --record-trajectory-dir, to pretrain the control models on')
+    parser.add_argument('--pretrain-epochs', type=int, default=10,
+                         help='epochs over the recorded transitions in pretrain_control_models.py')
+    parser.add_argument('--pretrain-batch-size', type=int, default=256,
+                         help='mini batch size in pretrain_control_models.py')
+    parser.add_argument('--pretrain-num-workers', type=int, default=4,
+                         help='DataLoader workers reading the recorded transitions in pretrain_control_models.py')
+    parser.add_argument('--traced-inference', action='store_true', default=False,
+                         help='run get_mask and update_C of the control models through TorchScript graphs traced and frozen after each update')
+    parser.add_argument('--folded-inference', action='store_true', default=False,
+                         help='run the per-step control maps and video summary on copies of the control models with BatchNorm folded into the convs and linears, refreshed after each update')
+    parser.add_argument('--skip-masked-cells', action='store_true', default=False,
+                         help='DirectControlModel.get_mask only evaluates the cells not zeroed by direct_control_masks/<Game>_<G>x<G>.txt, with the softmax over cells taken over those only, in training as well')
+    parser.add_argument('--index-actions', action='store_true', default=False,
+                         help='keep actions as indices rather than one-hots for the control models, in the rollouts and the replay buffer, and look up the columns of the action linears instead of multiplying one-hots; checkpoints of the control models are the same either way')
+    parser.add_argument('--control-model-mini-batch-size', type=int, default=None,
+                         help='mini batch size of the control model updates (default: num_processes)')
+    parser.add_argument('--control-model-checkpoint-rows', type=int, default=None,
+                         help='train LatentControlModel with its Phi/Gamma trunks checkpointed per chunk of this many batch*num_grid**4 rows, recomputing activations in backward to fit larger mini batches; update time and peak memory are reported (default: no checkpointing)')
+    parser.add_argument('--control-model-memory-budget-mb', type=float, default=None,
+                         help='split the LatentControlModel calls (update_C, training forward) into micro batches whose estimated activations fit in this many MB, accumulating gradients in training (default: no limit)')
+    parser.add_argument('--latent-control-neighborhood-radius', type=int, default=None,
+                         help='LatentControlModel only evaluates the source cells within this many cells of each target cell, (2r+1)**2 instead of num_grid**2 of them (default: all cells)')
+    parser.add_argument('--neighborhood-tradeoff-interval', type=int, default=None,
+                         help='with --latent-control-neighborhood-radius, report the loss and G against evaluating all cells every this many control model updates; this runs the dense model once (default: None, not reported)')
+    parser.add_argument('--quantized-inference', action='store_true', default=False,
+                         help='run the per-step control maps on int8 CPU copies of the control models (dynamic for linears, static for convs, calibrated on replay buffer samples), refreshed after each update; the video summary keeps the fp32 models')
+    parser.add_argument('--fused-branches', action='store_true', default=False,
+                         help='train the control models with the sibling Phi/Gamma conv branches run as single grouped convs and batched linears')
+    parser.add_argument('--async-eval', action='store_true', default=False,
+                         help='evaluate policy snapshots in a background process with a persistent env pool')
+    parser.add_argument('--obs-norm-cache-dir', default='../results/obs_norm_cache',
+                         help='directory of ObsNorm statistics shared by runs of the same game and preprocessing')
+    parser.add_argument('--fused-preprocess', action='store_true', default=False,
+                         help='grayscale, resize, crop and transpose atari frames in one wrapper with preallocated buffers')
+    parser.add_argument('--crop-mode', type=str, default='fill',
+                         help='fill: paint out-of-crop regions with 128; cut: drop out-of-crop regions so that the obs is smaller')
     args = parser.parse_args()
 
     args.cuda = not args.no_cuda and torch.cuda.is_available()
+    if args.device is None:
+        args.device = 'cuda:0' if args.cuda else 'cpu'
+    args.cuda = torch.device(args.device).type in ['cuda']
+
+    if args.async_envs_k is not None:
+        '''MEGA computes the intrinsic reward on synchronised steps of all envs: G,
+        DirectControlMask, the hash counts, RunningBinaryNorm and the reward
+        normalizer are all batched by num_processes, not by the ready envs'''
+        assert args.train_with_reward in ['ex'], '--async-envs-k only supports --train-with-reward ex, the intrinsic reward of MEGA is not computed on the ready subsets of envs'
+        assert 1 <= args.async_envs_k <= args.num_processes
 
     import os
     args.log_dir = ''
@@ -130,6 +242,9 @@ def get_args():
         args.log_dir = os.path.join(args.log_dir, 'nr-{}'.format(args.norm_rew))
 
         args.prioritized_replay_buffer_mode = 'random'
+        if args.index_actions:
+            '''the replay buffer stores actions another way'''
+            args.log_dir = os.path.join(args.log_dir, 'ia')
         args.log_dir = os.path.join(args.log_dir, 'prbm-{}'.format(args.prioritized_replay_buffer_mode))
 
         args.log_dir = os.path.join(args.log_dir, 'lcirt-{}'.format(args.latent_control_intrinsic_reward_type))
@@ -146,17 +261,22 @@ def get_args():
             else:
                 raise NotImplemented
 
-        args.control_model_mini_batch_size = args.num_processes
+        if args.control_model_mini_batch_size is None:
+            args.control_model_mini_batch_size = args.num_processes
+        else:
+            args.log_dir = os.path.join(args.log_dir, 'cmmbs-{}'.format(args.control_model_mini_batch_size))
         args.train_control_model_every = args.num_steps
         args.new_sample_every_train_control_model = args.train_control_model_every*args.num_processes
         args.prioritized_replay_buffer_size = args.new_sample_every_train_control_model * 2
-        args.num_interations_complete_a_push = int(args.new_sample_every_train_control_model/args.control_model_mini_batch_size)
+        args.num_interations_complete_a_push = max(1, int(args.new_sample_every_train_control_model/args.control_model_mini_batch_size))
         args.num_nobootup_iterations = args.num_interations_complete_a_push * 2
 
-        '''num updates when
+        '''args.num_bootup_updates is num updates when
         1, agent acting randomly
-        2, policy not updating'''
-        args.num_bootup_updates = 600
+        2, policy not updating
+        it can be shortened if the control models are pretrained'''
+        if args.pretrained_control_models_dir is not None:
+            args.log_dir = os.path.join(args.log_dir, 'pcm-nbu-{}'.format(args.num_bootup_updates))
 
         if args.norm_rew:
             args.num_estimate_norm_rew_updates = 20
@@ -195,6 +315,13 @@ def get_args():
             ))
         args.log_dir = os.path.join(args.log_dir, 'lcd-{}'.format(str(args.latent_control_discount).replace('.','_')))
 
+        if args.latent_control_neighborhood_radius is not None:
+            args.log_dir = os.path.join(args.log_dir, 'lcnr-{}'.format(args.latent_control_neighborhood_radius))
+
+        if args.skip_masked_cells:
+            '''M is normalized over the unmasked cells only'''
+            args.log_dir = os.path.join(args.log_dir, 'smc')
+
         '''default settings'''
         args.is_remove_inter_episode_transitions = True
         args.is_lantent_control_action_conditional = True
@@ -205,6 +332,9 @@ def get_args():
                 args.is_lantent_control_action_conditional,
             ))
 
+    if args.crop_mode in ['cut']:
+        args.log_dir = os.path.join(args.log_dir, 'cm-{}'.format(args.crop_mode))
+
     args.log_dir = os.path.join(args.log_dir, 'a-{}'.format(args.aux))
 
     args.log_dir = args.log_dir.replace('/','--')
@@ -300,6 +430,28 @@ def get_args():
     except Exception as e:
         input('# ACTION REQUIRED: model_structure is not defined for num_grid={}'.format(args.num_grid))
 
+    if args.crop_obs is not None:
+        args.crop_obs['mode'] = args.crop_mode
+        if args.crop_mode in ['cut']:
+            '''the cropped region is resized to a smaller square obs, so the
+            cropped pixels cost nothing in the policy and control models'''
+            args.obs_size = get_cut_obs_size(
+                crop_obs = args.crop_obs,
+                num_grid = args.num_grid,
+                model_structure = getattr(args, 'model_structure', {}),
+            )
+            args.crop_obs['size'] = args.obs_size
+            if args.num_grid is not None:
+                args.size_grid = int(args.obs_size/args.num_grid)
+                for name in getattr(args, 'model_structure', {}).keys():
+                    conved_size = get_conved_size(args.size_grid, args.model_structure[name])
+                    args.model_structure[name]['conved_shape'] = (args.model_structure[name]['conved_shape'][0], conved_size, conved_size)
+            print('# WARNING: args.crop_mode=cut, args.obs_size={}.'.format(args.obs_size))
+        elif args.crop_mode in ['fill']:
+            pass
+        else:
+            raise NotImplemented
+
     print('# INFO: args.norm_rew={}'.format(args.norm_rew))
 
     return args
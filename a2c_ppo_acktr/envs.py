@@ -1,13 +1,18 @@
 import os
+import json
+import time
+import multiprocessing
+import multiprocessing.connection
+import concurrent.futures
 
+import cv2
 import gym
 import numpy as np
 import torch
 from gym.spaces.box import Box
 
-from baselines import bench
-from baselines.common.atari_wrappers import make_atari, wrap_deepmind
-from baselines.common.vec_env import VecEnvWrapper
+from baselines.common.atari_wrappers import make_atari, wrap_deepmind, EpisodicLifeEnv, FireResetEnv, ClipRewardEnv
+from baselines.common.vec_env import VecEnv, VecEnvWrapper, CloudpickleWrapper
 from baselines.common.vec_env.subproc_vec_env import SubprocVecEnv
 from baselines.common.vec_env.dummy_vec_env import DummyVecEnv
 from baselines.common.vec_env.vec_normalize import VecNormalize as VecNormalize_
@@ -31,17 +36,202 @@ class ExtraTimeLimit(gym.Wrapper):
 
 class CropFrame(gym.ObservationWrapper):
     def __init__(self, env, crop_obs):
-        """Warp frames to 84x84 as done in the Nature paper and later work."""
+        """Crop frames, either by painting the out-of-crop regions with 128
+        (mode fill) or by cutting them out and resizing the cropped region to
+        a smaller square frame of crop_obs['size'] (mode cut)."""
         gym.ObservationWrapper.__init__(self, env)
         self.crop_obs = crop_obs
+        self.mode = self.crop_obs.get('mode', 'fill')
+        if self.mode in ['cut']:
+            self.size = self.crop_obs['size']
+            self.observation_space = Box(
+                low=0, high=255,
+                shape=(self.size, self.size, self.observation_space.shape[2]),
+                dtype=self.observation_space.dtype)
 
     def observation(self, frame):
+        if self.mode in ['cut']:
+            frame = cv2.resize(
+                frame[self.crop_obs['h'][0]:self.crop_obs['h'][1], self.crop_obs['w'][0]:self.crop_obs['w'][1]],
+                (self.size, self.size),
+                interpolation=cv2.INTER_AREA,
+            )
+            return frame.reshape(self.observation_space.shape)
         frame[:self.crop_obs['h'][0] ,:                      ].fill(128)
         frame[:                      ,:self.crop_obs['w'][0] ].fill(128)
         frame[ self.crop_obs['h'][1]:,:                      ].fill(128)
         frame[:                      , self.crop_obs['w'][1]:].fill(128)
         return frame
 
+class FusedAtariFrame(gym.ObservationWrapper):
+    def __init__(self, env, crop_obs, width=84, height=84):
+        """Grayscale, resize, crop and channel-first layout in a single pass,
+        replacing WarpFrame, CropFrame and TransposeImage. Frames are written
+        into buffers preallocated once per env, so the returned obs is only
+        valid until the next step."""
+        gym.ObservationWrapper.__init__(self, env)
+        self.crop_obs = crop_obs
+        self.mode = None if self.crop_obs is None else self.crop_obs.get('mode', 'fill')
+
+        raw_height, raw_width = self.observation_space.shape[:2]
+        self.gray = np.zeros((raw_height, raw_width), dtype=np.uint8)
+
+        if self.mode in ['cut']:
+            '''crop_obs is given on the warped frame, map it to the raw frame
+            so that the cropped region is resized only once'''
+            self.raw_h = [int(round(h*raw_height/height)) for h in self.crop_obs['h']]
+            self.raw_w = [int(round(w*raw_width /width )) for w in self.crop_obs['w']]
+            height, width = self.crop_obs['size'], self.crop_obs['size']
+        self.size = (width, height)
+
+        self.out = np.zeros((1, height, width), dtype=np.uint8)
+        self.frame = self.out[0]
+        self.observation_space = Box(low=0, high=255, shape=self.out.shape, dtype=np.uint8)
+
+    def observation(self, frame):
+        cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY, dst=self.gray)
+        if self.mode in ['cut']:
+            cv2.resize(self.gray[self.raw_h[0]:self.raw_h[1], self.raw_w[0]:self.raw_w[1]], self.size,
+                       dst=self.frame, interpolation=cv2.INTER_AREA)
+        else:
+            cv2.resize(self.gray, self.size, dst=self.frame, interpolation=cv2.INTER_AREA)
+            if self.mode in ['fill']:
+                self.frame[:self.crop_obs['h'][0] ,:                      ].fill(128)
+                self.frame[:                      ,:self.crop_obs['w'][0] ].fill(128)
+                self.frame[ self.crop_obs['h'][1]:,:                      ].fill(128)
+                self.frame[:                      , self.crop_obs['w'][1]:].fill(128)
+        return self.out
+
+def wrap_deepmind_fused(env, crop_obs):
+    """wrap_deepmind with the frame wrappers fused into FusedAtariFrame"""
+    env = EpisodicLifeEnv(env)
+    if 'FIRE' in env.unwrapped.get_action_meanings():
+        env = FireResetEnv(env)
+    env = FusedAtariFrame(env, crop_obs)
+    env = ClipRewardEnv(env)
+    return env
+class EpisodeStats(gym.Wrapper):
+    """Lightweight bench.Monitor: put the return and length of each finished
+    episode into info['episode'], the writing is left to VecEpisodeStats."""
+    def __init__(self, env):
+        gym.Wrapper.__init__(self, env)
+        self.episode_return = 0.0
+        self.episode_length = 0
+
+    def reset(self, **kwargs):
+        self.episode_return = 0.0
+        self.episode_length = 0
+        return self.env.reset(**kwargs)
+
+    def step(self, action):
+        ob, reward, done, info = self.env.step(action)
+        self.episode_return += reward
+        self.episode_length += 1
+        if done:
+            info['episode'] = {'r': self.episode_return, 'l': self.episode_length}
+        return ob, reward, done, info
+
+class EpisodeStatsWriter(object):
+    """Columnar writer of the episodes of all envs into a single file in the
+    bench.Monitor format, written in batches instead of a line per episode."""
+    def __init__(self, path, env_id, flush_every=100, flush_interval=10.0):
+        super(EpisodeStatsWriter, self).__init__()
+        self.t_start = time.time()
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.last_flush = self.t_start
+        self.f = open(path, 'wt')
+        self.f.write('#{}\n'.format(json.dumps({'t_start': self.t_start, 'env_id': env_id})))
+        self.f.write('r,l,t\n')
+        self.f.flush()
+        self.columns = [[], [], []]
+
+    def write(self, returns, lengths):
+        self.columns[0].append(returns)
+        self.columns[1].append(lengths)
+        self.columns[2].append(np.full(returns.shape, time.time()-self.t_start))
+        now = time.time()
+        if (sum([len(x) for x in self.columns[0]]) >= self.flush_every) or ((now-self.last_flush) >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.time()
+        if len(self.columns[0]) == 0:
+            return
+        np.savetxt(
+            self.f,
+            np.column_stack([np.concatenate(column) for column in self.columns]),
+            fmt=['%.6g', '%d', '%.6f'],
+            delimiter=',',
+        )
+        self.f.flush()
+        self.columns = [[], [], []]
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+class VecEpisodeStats(VecEnvWrapper):
+    """Gather info['episode'] of the envs into preallocated arrays, so that
+    callers read returns[dones] instead of scanning infos, and log them with
+    a single EpisodeStatsWriter when log_dir is given."""
+    num_writers = 0
+
+    def __init__(self, venv, log_dir=None, env_id=None):
+        super(VecEpisodeStats, self).__init__(venv)
+        self.returns = np.zeros((self.num_envs,), dtype=np.float64)
+        self.lengths = np.zeros((self.num_envs,), dtype=np.int64)
+        self.dones = np.zeros((self.num_envs,), dtype=bool)
+        self.writer = None
+        if log_dir is not None:
+            '''several vec envs, possibly of several processes, may log into log_dir'''
+            VecEpisodeStats.num_writers += 1
+            self.writer = EpisodeStatsWriter(os.path.join(log_dir, 'episodes.{}.{}.monitor.csv'.format(
+                os.getpid(), VecEpisodeStats.num_writers)), env_id)
+
+    def reset(self):
+        self.dones.fill(False)
+        return self.venv.reset()
+
+    def step_async(self, actions, env_ids=None):
+        if env_ids is None:
+            self.venv.step_async(actions)
+        else:
+            self.venv.step_async(actions, env_ids)
+
+    def step_wait(self):
+        obs, rews, news, infos = self.venv.step_wait()
+        '''the rows may be a subset of the envs, when they are stepped asynchronously'''
+        env_ids = get_ready_ids(self.venv)
+        self.dones.fill(False)
+        for row in np.nonzero(news)[0]:
+            i = row if env_ids is None else env_ids[row]
+            episode = infos[row].get('episode')
+            if episode is not None:
+                self.returns[i] = episode['r']
+                self.lengths[i] = episode['l']
+                self.dones[i] = True
+        if self.writer is not None and self.dones.any():
+            self.writer.write(self.returns[self.dones], self.lengths[self.dones])
+        return obs, rews, news, infos
+
+    def get_episode_returns(self):
+        '''returns of the episodes finished by the last step'''
+        return self.returns[self.dones]
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.venv.close()
+
+def get_vec_episode_stats(venv):
+    if isinstance(venv, VecEpisodeStats):
+        return venv
+    elif hasattr(venv, 'venv'):
+        return get_vec_episode_stats(venv.venv)
+    return None
+
 try:
     import dm_control2gym
 except ImportError:
@@ -58,7 +248,7 @@ except ImportError:
     pass
 
 
-def make_env(env_id, seed, rank, log_dir, add_timestep, allow_early_resets, crop_obs):
+def make_env(env_id, seed, rank, log_dir, add_timestep, allow_early_resets, crop_obs, fused_preprocess=False):
     def _thunk():
         if env_id.startswith("dm"):
             _, domain, task = env_id.split('.')
@@ -84,15 +274,17 @@ def make_env(env_id, seed, rank, log_dir, add_timestep, allow_early_resets, crop
                 obs_shape) == 1 and str(env).find('TimeLimit') > -1:
             env = AddTimestep(env)
 
-        if log_dir is not None:
-            env = bench.Monitor(env, os.path.join(log_dir, str(rank)),
-                                allow_early_resets=allow_early_resets)
+        '''episodes are logged by VecEpisodeStats in the trainer'''
+        env = EpisodeStats(env)
 
         if is_atari:
             if len(env.observation_space.shape) == 3:
-                env = wrap_deepmind(env)
-                if crop_obs is not None:
-                    env = CropFrame(env,crop_obs)
+                if fused_preprocess:
+                    env = wrap_deepmind_fused(env, crop_obs)
+                else:
+                    env = wrap_deepmind(env)
+                    if crop_obs is not None:
+                        env = CropFrame(env,crop_obs)
         elif len(env.observation_space.shape) == 3:
             raise NotImplementedError("CNN models work only for atari,\n"
                 "please use a custom wrapper for a custom pixel input env.\n"
@@ -107,16 +299,65 @@ def make_env(env_id, seed, rank, log_dir, add_timestep, allow_early_resets, crop
 
     return _thunk
 
-def make_vec_envs(env_name, seed, num_processes, gamma, log_dir, add_timestep,
-                  device, allow_early_resets, crop_obs, num_frame_stack=None):
-    envs = [make_env(env_name, seed, i, log_dir, add_timestep, allow_early_resets,crop_obs)
+def make_env_backend(env_name, seed, num_processes, log_dir, add_timestep,
+                     allow_early_resets, crop_obs, num_envs_per_worker,
+                     fused_preprocess, warm_start, ready_k, ready_timeout, vec_env):
+    '''the VecEnv running the emulators of make_vec_envs'''
+    envs = [make_env(env_name, seed, i, log_dir, add_timestep, allow_early_resets,crop_obs,fused_preprocess)
             for i in range(num_processes)]
 
-    if len(envs) > 1:
-        envs = SubprocVecEnv(envs)
+    if (ready_k is None) and (len(envs) > 1) and (vec_env in ['auto']):
+        vec_env = select_vec_env(envs[0])
+
+    if ready_k is not None:
+        if warm_start:
+            warm_rom(env_name)
+        envs = AsyncSubprocVecEnv(envs, ready_k, ready_timeout,
+                                  context=get_warm_context() if warm_start else None)
+    elif (len(envs) > 1) and (vec_env in ['thread']):
+        envs = ThreadVecEnv(envs)
+    elif len(envs) > 1:
+        if warm_start:
+            warm_rom(env_name)
+            envs = BatchedSubprocVecEnv(envs, num_envs_per_worker, context=get_warm_context())
+        elif num_envs_per_worker > 1:
+            envs = BatchedSubprocVecEnv(envs, num_envs_per_worker)
+        else:
+            envs = SubprocVecEnv(envs)
     else:
         envs = DummyVecEnv(envs)
 
+    return envs
+
+def make_vec_envs(env_name, seed, num_processes, gamma, log_dir, add_timestep,
+                  device, allow_early_resets, crop_obs, num_frame_stack=None,
+                  num_envs_per_worker=1, fused_preprocess=False, warm_start=False,
+                  ready_k=None, ready_timeout=None, vec_env='subproc',
+                  record_dir=None, record_steps=None, replay_dir=None):
+    time_start = time.time()
+
+    if (record_dir is not None) or (replay_dir is not None):
+        assert ready_k is None, 'trajectories are recorded and replayed with all envs stepped together'
+
+    if replay_dir is not None:
+        '''no emulators to start, the replayed envs only get the wrappers below'''
+        envs = ReplayVecEnv(replay_dir, num_processes)
+    else:
+        envs = make_env_backend(env_name, seed, num_processes, log_dir, add_timestep,
+                                allow_early_resets, crop_obs, num_envs_per_worker,
+                                fused_preprocess, warm_start, ready_k, ready_timeout, vec_env)
+
+    print('# INFO: {} envs of {} started in {:.2f}s'.format(
+        num_processes,
+        env_name,
+        time.time()-time_start,
+    ))
+
+    if record_dir is not None:
+        envs = VecTrajectoryRecorder(envs, record_dir, record_steps, env_name)
+
+    envs = VecEpisodeStats(envs, log_dir, env_name)
+
     if len(envs.observation_space.shape) == 1:
         if gamma is None:
             envs = VecNormalize(envs, ret=False)
@@ -133,6 +374,524 @@ def make_vec_envs(env_name, seed, num_processes, gamma, log_dir, add_timestep,
     return envs
 
 
+'''imported once by the forkserver, so that warm workers are forked with them loaded.
+A forkserver child imports the main script again as __mp_main__, with everything it
+imports (tensorflow, a2c_ppo_acktr.utils, a2c_ppo_acktr.model, ...), so '__main__' is
+preloaded as well: the server imports the main script once, and the children find
+it in sys.modules. The main script has to keep its side effects under
+if __name__ == '__main__' for this'''
+WARM_PRELOAD_MODULES = [
+    '__main__',
+    'numpy',
+    'cv2',
+    'torch',
+    'tensorflow',
+    'gym',
+    'atari_py',
+    'baselines.common.atari_wrappers',
+    'a2c_ppo_acktr.envs',
+    'a2c_ppo_acktr.utils',
+    'a2c_ppo_acktr.model',
+    'a2c_ppo_acktr.storage',
+    'a2c_ppo_acktr.algo',
+]
+
+def get_warm_context():
+    '''forkserver context whose server preloads WARM_PRELOAD_MODULES,
+    modules failing to import are skipped by the server'''
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(WARM_PRELOAD_MODULES)
+    return context
+
+def warm_rom(env_id):
+    '''read the ROM file once, so that it is in the OS page cache when the
+    workers open it. This only saves the disk reads, each worker still
+    loads the ROM into its own emulator'''
+    try:
+        import atari_py
+        with open(atari_py.get_game_path(gym.spec(env_id)._kwargs['game']), 'rb') as rom:
+            rom.read()
+    except Exception as e:
+        print('# WARNING: ROM of {} not warmed, due to {}'.format(env_id, e))
+
+def batched_worker(remote, parent_remote, env_fn_wrapper):
+    '''Host several envs in one process and step them in a loop.'''
+    parent_remote.close()
+    envs = [env_fn() for env_fn in env_fn_wrapper.x]
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'step':
+                obs, rews, dones, infos = [], [], [], []
+                for env, action in zip(envs, data):
+                    ob, reward, done, info = env.step(action)
+                    if done:
+                        ob = env.reset()
+                    obs.append(ob)
+                    rews.append(reward)
+                    dones.append(done)
+                    infos.append(info)
+                remote.send((np.stack(obs), np.stack(rews), np.stack(dones), infos))
+            elif cmd == 'reset':
+                remote.send(np.stack([env.reset() for env in envs]))
+            elif cmd == 'get_spaces':
+                remote.send((envs[0].observation_space, envs[0].action_space))
+            elif cmd == 'close':
+                remote.close()
+                break
+            else:
+                raise NotImplementedError
+    except KeyboardInterrupt:
+        print('# WARNING: batched_worker got KeyboardInterrupt')
+    finally:
+        for env in envs:
+            env.close()
+
+
+class BatchedSubprocVecEnv(VecEnv):
+    """SubprocVecEnv that hosts num_envs_per_worker envs in each worker, so
+    that num_processes envs cost num_processes/num_envs_per_worker processes
+    and pipes. Each worker returns one stacked block per step."""
+    def __init__(self, env_fns, num_envs_per_worker, context=None):
+        self.waiting = False
+        self.closed = False
+        self.num_envs_per_worker = num_envs_per_worker
+        if context is None:
+            context = multiprocessing
+
+        env_fns_batches = [env_fns[i:i+num_envs_per_worker]
+                           for i in range(0, len(env_fns), num_envs_per_worker)]
+        '''env i is hosted by worker i//num_envs_per_worker'''
+        self.worker_splits = np.cumsum([len(batch) for batch in env_fns_batches])[:-1]
+
+        self.remotes, self.work_remotes = zip(*[context.Pipe() for _ in env_fns_batches])
+        self.ps = [context.Process(target=batched_worker, args=(work_remote, remote, CloudpickleWrapper(env_fns_batch)))
+                   for (work_remote, remote, env_fns_batch) in zip(self.work_remotes, self.remotes, env_fns_batches)]
+        for p in self.ps:
+            # if the main process crashes, we should not cause things to hang
+            p.daemon = True
+            p.start()
+        for remote in self.work_remotes:
+            remote.close()
+
+        self.remotes[0].send(('get_spaces', None))
+        observation_space, action_space = self.remotes[0].recv()
+        VecEnv.__init__(self, len(env_fns), observation_space, action_space)
+
+        print('# INFO: {} envs hosted by {} workers'.format(len(env_fns), len(self.ps)))
+
+    def step_async(self, actions):
+        for remote, action in zip(self.remotes, np.split(actions, self.worker_splits)):
+            remote.send(('step', action))
+        self.waiting = True
+
+    def step_wait(self):
+        results = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        obs, rews, dones, infos = zip(*results)
+        return np.concatenate(obs), np.concatenate(rews), np.concatenate(dones), [info for worker_infos in infos for info in worker_infos]
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        return np.concatenate([remote.recv() for remote in self.remotes])
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for p in self.ps:
+            p.join()
+        self.closed = True
+
+class AsyncSubprocVecEnv(VecEnv):
+    """SubprocVecEnv that does not wait for stragglers: step_wait returns as
+    soon as ready_k envs have stepped, or once ready_timeout seconds have
+    passed with at least one env stepped, and ready_ids tells which envs the
+    returned rows are. step_async then dispatches only the given env_ids
+    (the envs last returned by default), the others keep stepping."""
+    def __init__(self, env_fns, ready_k, ready_timeout=None, context=None):
+        self.closed = False
+        self.ready_k = ready_k
+        self.ready_timeout = ready_timeout
+        if context is None:
+            context = multiprocessing
+
+        self.remotes, self.work_remotes = zip(*[context.Pipe() for _ in env_fns])
+        self.ps = [context.Process(target=batched_worker, args=(work_remote, remote, CloudpickleWrapper([env_fn])))
+                   for (work_remote, remote, env_fn) in zip(self.work_remotes, self.remotes, env_fns)]
+        for p in self.ps:
+            # if the main process crashes, we should not cause things to hang
+            p.daemon = True
+            p.start()
+        for remote in self.work_remotes:
+            remote.close()
+        self.remote_ids = {remote: i for i, remote in enumerate(self.remotes)}
+
+        self.remotes[0].send(('get_spaces', None))
+        observation_space, action_space = self.remotes[0].recv()
+        VecEnv.__init__(self, len(env_fns), observation_space, action_space)
+
+        self.pending = set()
+        self.ready_ids = np.arange(self.num_envs)
+
+        print('# INFO: {} envs stepped asynchronously, ready_k {}, ready_timeout {}'.format(
+            self.num_envs, self.ready_k, self.ready_timeout))
+
+    def step_async(self, actions, env_ids=None):
+        if env_ids is None:
+            env_ids = self.ready_ids
+        for i, action in zip(env_ids, actions):
+            assert i not in self.pending
+            self.remotes[i].send(('step', action[np.newaxis]))
+            self.pending.add(i)
+
+    def step_wait(self):
+        results = {}
+        ready_k = min(self.ready_k, len(self.pending))
+        deadline = None if self.ready_timeout is None else (time.time()+self.ready_timeout)
+        while len(results) < ready_k:
+            if (deadline is None) or (len(results) == 0):
+                timeout = None
+            else:
+                timeout = max(0.0, deadline-time.time())
+            remotes = multiprocessing.connection.wait([self.remotes[i] for i in self.pending], timeout)
+            if len(remotes) == 0:
+                break
+            for remote in remotes:
+                i = self.remote_ids[remote]
+                results[i] = remote.recv()
+                self.pending.remove(i)
+        '''also take the envs that are already done, they are free to have'''
+        for remote in multiprocessing.connection.wait([self.remotes[i] for i in self.pending], 0):
+            i = self.remote_ids[remote]
+            results[i] = remote.recv()
+            self.pending.remove(i)
+
+        self.ready_ids = np.array(sorted(results.keys()), dtype=np.int64)
+        if len(results) == 0:
+            '''nothing was pending, no env to return'''
+            return (np.zeros((0,)+self.observation_space.shape, dtype=self.observation_space.dtype),
+                    np.zeros((0,), dtype=np.float32), np.zeros((0,), dtype=bool), [])
+        obs, rews, dones, infos = zip(*[results[i] for i in self.ready_ids])
+        return np.concatenate(obs), np.concatenate(rews), np.concatenate(dones), [info for env_infos in infos for info in env_infos]
+
+    def drain(self):
+        for i in self.pending:
+            self.remotes[i].recv()
+        self.pending = set()
+
+    def reset(self):
+        self.drain()
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        self.ready_ids = np.arange(self.num_envs)
+        return np.concatenate([remote.recv() for remote in self.remotes])
+
+    def close(self):
+        if self.closed:
+            return
+        self.drain()
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for p in self.ps:
+            p.join()
+        self.closed = True
+
+def get_ready_ids(venv):
+    '''ids of the envs returned by the last step_wait, None if all of them'''
+    if isinstance(venv, AsyncSubprocVecEnv):
+        return venv.ready_ids
+    elif hasattr(venv, 'venv'):
+        return get_ready_ids(venv.venv)
+    return None
+
+class ThreadVecEnv(VecEnv):
+    """Step the envs concurrently in a thread pool in the main process, so
+    that obs are never pickled. Envs run in parallel only where they release
+    the GIL (the ALE does, while emulating), so it suits cheap envs, where
+    the pipes of SubprocVecEnv would cost more than the steps themselves."""
+    def __init__(self, env_fns, num_threads=None):
+        self.envs = [env_fn() for env_fn in env_fns]
+        env = self.envs[0]
+        VecEnv.__init__(self, len(env_fns), env.observation_space, env.action_space)
+        if num_threads is None:
+            num_threads = min(self.num_envs, multiprocessing.cpu_count())
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=num_threads)
+        self.futures = None
+
+        self.buf_obs = np.zeros((self.num_envs,)+env.observation_space.shape, dtype=env.observation_space.dtype)
+        self.buf_rews = np.zeros((self.num_envs,), dtype=np.float32)
+        self.buf_dones = np.zeros((self.num_envs,), dtype=bool)
+        self.buf_infos = [{} for _ in range(self.num_envs)]
+
+        print('# INFO: {} envs stepped by {} threads'.format(self.num_envs, num_threads))
+
+    def step_env(self, i, action):
+        '''obs is copied into buf_obs, wrappers may return a reused buffer'''
+        ob, self.buf_rews[i], self.buf_dones[i], self.buf_infos[i] = self.envs[i].step(action)
+        if self.buf_dones[i]:
+            ob = self.envs[i].reset()
+        self.buf_obs[i] = ob
+
+    def reset_env(self, i):
+        self.buf_obs[i] = self.envs[i].reset()
+
+    def step_async(self, actions):
+        self.futures = [self.pool.submit(self.step_env, i, action) for i, action in enumerate(actions)]
+
+    def step_wait(self):
+        for future in self.futures:
+            future.result()
+        self.futures = None
+        return np.copy(self.buf_obs), np.copy(self.buf_rews), np.copy(self.buf_dones), list(self.buf_infos)
+
+    def reset(self):
+        for future in [self.pool.submit(self.reset_env, i) for i in range(self.num_envs)]:
+            future.result()
+        return np.copy(self.buf_obs)
+
+    def close(self):
+        if self.futures is not None:
+            for future in self.futures:
+                future.result()
+        self.pool.shutdown()
+        for env in self.envs:
+            env.close()
+
+'''auto picks thread when a step costs less than this many pipe round trips of its obs'''
+VEC_ENV_AUTO_IPC_RATIO = 2.0
+
+def select_vec_env(env_fn, num_probe_steps=200):
+    '''time a step of one probe env against a pipe round trip of its obs,
+    return 'thread' if the pipes of SubprocVecEnv would dominate, else 'subproc' '''
+    env = env_fn()
+    env.reset()
+    time_start = time.time()
+    for _ in range(num_probe_steps):
+        ob, _, done, _ = env.step(env.action_space.sample())
+        if done:
+            env.reset()
+    step_time = (time.time()-time_start)/num_probe_steps
+    env.close()
+
+    remote, work_remote = multiprocessing.Pipe()
+    time_start = time.time()
+    for _ in range(num_probe_steps):
+        work_remote.send((ob, 0.0, False, {}))
+        remote.recv()
+    ipc_time = (time.time()-time_start)/num_probe_steps
+    remote.close()
+    work_remote.close()
+
+    vec_env = 'thread' if step_time < (VEC_ENV_AUTO_IPC_RATIO*ipc_time) else 'subproc'
+    print('# INFO: step {:.6f}s, ipc {:.6f}s, select {} vec env'.format(step_time, ipc_time, vec_env))
+    return vec_env
+
+'''arrays of a recorded trajectory, (num_steps+1, num_processes, ...) for frames'''
+TRAJECTORY_ARRAYS = ['frames', 'actions', 'rewards', 'dones', 'episode_returns', 'episode_lengths']
+
+class VecTrajectoryRecorder(VecEnvWrapper):
+    """Record the frames (uint8), actions, rewards and dones of the first
+    num_steps steps of venv into memory-mapped .npy files in record_dir, to
+    be fed back by ReplayVecEnv. Recording stops when the files are full or
+    when venv is reset again."""
+    def __init__(self, venv, record_dir, num_steps, env_id=None):
+        super(VecTrajectoryRecorder, self).__init__(venv)
+        try:
+            os.makedirs(record_dir)
+        except OSError:
+            pass
+        self.record_dir = record_dir
+        self.num_steps = num_steps
+        self.env_id = env_id
+
+        def open_array(name, shape, dtype):
+            return np.lib.format.open_memmap(os.path.join(record_dir, '{}.npy'.format(name)),
+                mode='w+', dtype=dtype, shape=shape)
+        self.arrays = {
+            'frames'          : open_array('frames'         , (num_steps+1, self.num_envs)+self.observation_space.shape, np.uint8),
+            'actions'         : open_array('actions'        , (num_steps  , self.num_envs)+self.action_space.shape     , self.action_space.dtype),
+            'rewards'         : open_array('rewards'        , (num_steps  , self.num_envs), np.float32),
+            'dones'           : open_array('dones'          , (num_steps  , self.num_envs), bool),
+            'episode_returns' : open_array('episode_returns', (num_steps  , self.num_envs), np.float32),
+            'episode_lengths' : open_array('episode_lengths', (num_steps  , self.num_envs), np.int32),
+        }
+        self.step = None
+
+    def reset(self):
+        obs = self.venv.reset()
+        if self.step is None:
+            self.arrays['frames'][0] = obs
+            self.step = 0
+        elif self.step < self.num_steps:
+            print('# WARNING: VecTrajectoryRecorder: envs reset, recording stopped at step {}'.format(self.step))
+            self.stop()
+        return obs
+
+    def step_async(self, actions):
+        if (self.step is not None) and (self.step < self.num_steps):
+            self.arrays['actions'][self.step] = actions
+        self.venv.step_async(actions)
+
+    def step_wait(self):
+        obs, rews, dones, infos = self.venv.step_wait()
+        if (self.step is not None) and (self.step < self.num_steps):
+            self.arrays['frames'][self.step+1] = obs
+            self.arrays['rewards'][self.step] = rews
+            self.arrays['dones'][self.step] = dones
+            self.arrays['episode_returns'][self.step] = np.nan
+            for i in np.nonzero(dones)[0]:
+                if 'episode' in infos[i]:
+                    self.arrays['episode_returns'][self.step, i] = infos[i]['episode']['r']
+                    self.arrays['episode_lengths'][self.step, i] = infos[i]['episode']['l']
+            self.step += 1
+            if self.step == self.num_steps:
+                self.stop()
+        return obs, rews, dones, infos
+
+    def stop(self):
+        for array in self.arrays.values():
+            array.flush()
+        with open(os.path.join(self.record_dir, 'meta.json'), 'w') as f:
+            json.dump({
+                'env_id': self.env_id,
+                'num_steps': self.step,
+                'num_processes': self.num_envs,
+                'action_space_n': int(self.action_space.n),
+            }, f)
+        print('# INFO: VecTrajectoryRecorder: {} steps of {} envs recorded to {}'.format(
+            self.step, self.num_envs, self.record_dir))
+        self.step = self.num_steps
+
+    def close(self):
+        if (self.step is not None) and (self.step < self.num_steps):
+            self.stop()
+        self.venv.close()
+
+class ReplayVecEnv(VecEnv):
+    """Feed a trajectory recorded by VecTrajectoryRecorder back at memory
+    speed, without emulators. The actions given to step_async are ignored,
+    get_replay_actions tells the recorded actions to take instead. When the
+    recording runs out it starts over, with all envs done."""
+    def __init__(self, replay_dir, num_envs):
+        with open(os.path.join(replay_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.num_steps = meta['num_steps']
+        assert num_envs <= meta['num_processes'], '{} envs requested, only {} recorded in {}'.format(
+            num_envs, meta['num_processes'], replay_dir)
+        self.arrays = {name: np.load(os.path.join(replay_dir, '{}.npy'.format(name)), mmap_mode='r')[:, :num_envs]
+                       for name in TRAJECTORY_ARRAYS}
+        VecEnv.__init__(self, num_envs,
+            Box(low=0, high=255, shape=self.arrays['frames'].shape[2:], dtype=np.uint8),
+            gym.spaces.Discrete(meta['action_space_n']))
+        self.step = 0
+        print('# INFO: replay {} steps of {} envs from {}'.format(self.num_steps, num_envs, replay_dir))
+
+    def reset(self):
+        self.step = 0
+        return np.array(self.arrays['frames'][0])
+
+    def get_replay_actions(self):
+        '''actions recorded for the next step'''
+        return np.array(self.arrays['actions'][self.step])
+
+    def step_async(self, actions):
+        pass
+
+    def step_wait(self):
+        rews = np.array(self.arrays['rewards'][self.step])
+        dones = np.array(self.arrays['dones'][self.step])
+        infos = [{} for _ in range(self.num_envs)]
+        for i in np.nonzero(dones)[0]:
+            if not np.isnan(self.arrays['episode_returns'][self.step, i]):
+                infos[i]['episode'] = {
+                    'r': float(self.arrays['episode_returns'][self.step, i]),
+                    'l': int(self.arrays['episode_lengths'][self.step, i]),
+                }
+        self.step += 1
+        if self.step >= self.num_steps:
+            self.step = 0
+            dones.fill(True)
+        return np.array(self.arrays['frames'][self.step]), rews, dones, infos
+
+    def close(self):
+        self.arrays = None
+
+def get_replay_actions(venv):
+    '''recorded actions for the next step of a ReplayVecEnv, None if venv is not replaying'''
+    if isinstance(venv, ReplayVecEnv):
+        return venv.get_replay_actions()
+    elif hasattr(venv, 'venv'):
+        return get_replay_actions(venv.venv)
+    return None
+
+
+class VecEnvPool(object):
+    """Hand out vec envs keyed by their make_vec_envs arguments (env, seed
+    range, wrappers) and recycle released ones instead of spawning and
+    loading new workers. A recycled vec env is handed out as it was left,
+    callers start with reset() anyway."""
+    def __init__(self, device):
+        super(VecEnvPool, self).__init__()
+        self.device = device
+        self.free = {}
+        self.keys = {}
+        self.acquired = {}
+
+    def get_key(self, make_vec_envs_kwargs):
+        return tuple(sorted([(name, repr(value)) for name, value in make_vec_envs_kwargs.items()]))
+
+    def acquire(self, close_other_free=False, **make_vec_envs_kwargs):
+        '''close_other_free closes the free envs of any other arguments first,
+        for callers that will not hand them back to anyone (e.g. training,
+        whose record/async/replay arguments differ from those of ObsNorm).
+        Recycled envs are reset mid-episode, so early resets are always allowed'''
+        make_vec_envs_kwargs['allow_early_resets'] = True
+        key = self.get_key(make_vec_envs_kwargs)
+        if close_other_free:
+            self.close_free(except_key=key)
+        if len(self.free.get(key, []))>0:
+            envs = self.free[key].pop()
+            print('# INFO: VecEnvPool: recycle {} envs of {}'.format(envs.num_envs, make_vec_envs_kwargs['env_name']))
+        else:
+            envs = make_vec_envs(device=self.device, **make_vec_envs_kwargs)
+            self.keys[id(envs)] = key
+        self.acquired[id(envs)] = envs
+        return envs
+
+    def release(self, envs):
+        del self.acquired[id(envs)]
+        self.free.setdefault(self.keys[id(envs)], []).append(envs)
+
+    def discard(self, envs):
+        '''close acquired envs that will not be asked for again, instead of releasing them'''
+        del self.acquired[id(envs)]
+        del self.keys[id(envs)]
+        envs.close()
+
+    def close_free(self, except_key=None):
+        for key in list(self.free.keys()):
+            if key == except_key:
+                continue
+            for envs in self.free.pop(key):
+                print('# INFO: VecEnvPool: close {} free envs'.format(envs.num_envs))
+                del self.keys[id(envs)]
+                envs.close()
+
+    def close(self):
+        '''close the free envs and the ones still acquired'''
+        self.close_free()
+        for envs in self.acquired.values():
+            del self.keys[id(envs)]
+            envs.close()
+        self.acquired = {}
+
+
 # Can be used to test recurrent policies for Reacher-v2
 class MaskGoal(gym.ObservationWrapper):
     def observation(self, observation):
@@ -180,9 +939,12 @@ class VecPyTorch(VecEnvWrapper):
         obs = torch.from_numpy(obs).float().to(self.device)
         return obs
 
-    def step_async(self, actions):
+    def step_async(self, actions, env_ids=None):
         actions = actions.squeeze(1).cpu().numpy()
-        self.venv.step_async(actions)
+        if env_ids is None:
+            self.venv.step_async(actions)
+        else:
+            self.venv.step_async(actions, env_ids)
 
     def step_wait(self):
         obs, reward, done, info = self.venv.step_wait()
@@ -234,8 +996,27 @@ class VecPyTorchFrameStack(VecEnvWrapper):
             low=low, high=high, dtype=venv.observation_space.dtype)
         VecEnvWrapper.__init__(self, venv, observation_space=observation_space)
 
+    def step_async(self, actions, env_ids=None):
+        if env_ids is None:
+            self.venv.step_async(actions)
+        else:
+            self.venv.step_async(actions, env_ids)
+
     def step_wait(self):
         obs, rews, news, infos = self.venv.step_wait()
+        ready_ids = get_ready_ids(self.venv)
+        if ready_ids is not None:
+            '''only the envs that have stepped shift their stacks'''
+            ready_ids = torch.from_numpy(ready_ids)
+            stacked_obs = self.stacked_obs[ready_ids]
+            stacked_obs[:, :-self.shape_dim0] = \
+                stacked_obs[:, self.shape_dim0:].clone()
+            for (i, new) in enumerate(news):
+                if new:
+                    stacked_obs[i] = 0
+            stacked_obs[:, -self.shape_dim0:] = obs
+            self.stacked_obs[ready_ids] = stacked_obs
+            return stacked_obs, rews, news, infos
         self.stacked_obs[:, :-self.shape_dim0] = \
             self.stacked_obs[:, self.shape_dim0:]
         for (i, new) in enumerate(news):
@@ -1,10 +1,14 @@
+import copy
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 import numpy as np
 
 from a2c_ppo_acktr.distributions import Categorical, DiagGaussian, Bernoulli
 from a2c_ppo_acktr.utils import init
+from a2c_ppo_acktr.arguments import conv_out_size
 
 class Scale(nn.Module):
     def __init__(self, scale):
@@ -34,6 +38,7 @@ class Policy(nn.Module):
         if base is None:
             if len(obs_shape) == 3:
                 base = CNNBase
+                base_kwargs = dict(base_kwargs, obs_size=obs_shape[1])
             elif len(obs_shape) == 1:
                 base = MLPBase
             else:
@@ -185,9 +190,12 @@ class NNBase(nn.Module):
 
 
 class CNNBase(NNBase):
-    def __init__(self, num_inputs, recurrent=False, hidden_size=512):
+    def __init__(self, num_inputs, recurrent=False, hidden_size=512, obs_size=84):
         super(CNNBase, self).__init__(recurrent, hidden_size, hidden_size)
 
+        # 84 -> 20 -> 9 -> 7
+        conved_size = conv_out_size(conv_out_size(conv_out_size(obs_size, 8, 4), 4, 2), 3, 1)
+
         init_ = lambda m: init(m,
             nn.init.orthogonal_,
             lambda x: nn.init.constant_(x, 0),
@@ -201,7 +209,7 @@ class CNNBase(NNBase):
             init_(nn.Conv2d(64, 32, 3, stride=1)),
             nn.ReLU(),
             Flatten(),
-            init_(nn.Linear(32 * 7 * 7, hidden_size)),
+            init_(nn.Linear(32 * conved_size * conved_size, hidden_size)),
             nn.ReLU()
         )
 
@@ -264,10 +272,117 @@ class MLPBase(NNBase):
         return self.critic_linear(hidden_critic), hidden_actor, rnn_hxs
 
 
+def fused_batch_norm(batch_norm_a, batch_norm_b, x):
+    '''batch_norm_a and batch_norm_b on the channels of x stacked as (a, b),
+    running statistics are updated in both when training'''
+    num_features = batch_norm_a.num_features
+    running_mean = torch.cat([batch_norm_a.running_mean, batch_norm_b.running_mean])
+    running_var  = torch.cat([batch_norm_a.running_var , batch_norm_b.running_var ])
+    x = F.batch_norm(
+        x, running_mean, running_var,
+        torch.cat([batch_norm_a.weight, batch_norm_b.weight]),
+        torch.cat([batch_norm_a.bias  , batch_norm_b.bias  ]),
+        batch_norm_a.training, batch_norm_a.momentum, batch_norm_a.eps,
+    )
+    if batch_norm_a.training:
+        with torch.no_grad():
+            batch_norm_a.running_mean.copy_(running_mean[:num_features])
+            batch_norm_b.running_mean.copy_(running_mean[num_features:])
+            batch_norm_a.running_var .copy_(running_var [:num_features])
+            batch_norm_b.running_var .copy_(running_var [num_features:])
+            batch_norm_a.num_batches_tracked += 1
+            batch_norm_b.num_batches_tracked += 1
+    return x
+
+def fused_sibling_linears(linear_a, linear_b, x):
+    '''linear_a(x) and linear_b(x) as one linear, x may be action indices, see embed_actions'''
+    if x.dtype == torch.long:
+        y = F.embedding(x.view(-1), torch.cat([linear_a.weight, linear_b.weight]).t()) + torch.cat([linear_a.bias, linear_b.bias])
+    else:
+        y = F.linear(x, torch.cat([linear_a.weight, linear_b.weight]), torch.cat([linear_a.bias, linear_b.bias]))
+    return y[:,:linear_a.out_features], y[:,linear_a.out_features:]
+
+def embed_actions(linear, actions, action_space_n):
+    '''linear(onehot_actions) for the onehot_actions or the action indices
+    (long, (batch_size, 1)) in actions. For indices the columns of
+    linear.weight are looked up, instead of multiplying it by a one-hot'''
+    if actions.dtype != torch.long:
+        return linear(actions)
+    if not isinstance(linear, nn.Linear):
+        '''e.g. dynamically quantized, without a weight to look up'''
+        return linear(F.one_hot(actions.view(-1), action_space_n).float())
+    return F.embedding(actions.view(-1), linear.weight.t()) + linear.bias
+
+def fused_sibling_branches(branch_a, branch_b, x, b_input_channels=None):
+    '''branch_a(x) and branch_b(x[:,b_input_channels[0]:b_input_channels[1]])
+    for two nn.Sequential of identical geometry (conv, BatchNorm, LeakyReLU,
+    Flatten, Linear), with the channels of both branches stacked as (a, b):
+    the first conv serves both with its output channels stacked, later convs
+    are grouped convs and linears are bmm. Weights are concatenated from the
+    parameters of the branches on every call, so these stay the ones trained
+    and stored.'''
+    batch_size = x.size()[0]
+    is_stacked = False
+    for (name, a), (_, b) in zip(branch_a.named_children(), branch_b.named_children()):
+        if isinstance(a, nn.Conv2d):
+            if not is_stacked:
+                weight_b = b.weight
+                if b_input_channels is not None:
+                    '''zero weights on the input channels branch_b does not take'''
+                    weight_b = F.pad(weight_b, (0, 0, 0, 0, b_input_channels[0], x.size()[1]-b_input_channels[1]))
+                x = F.conv2d(x, torch.cat([a.weight, weight_b]), torch.cat([a.bias, b.bias]),
+                             a.stride, a.padding, a.dilation)
+                is_stacked = True
+            else:
+                x = F.conv2d(x, torch.cat([a.weight, b.weight]), torch.cat([a.bias, b.bias]),
+                             a.stride, a.padding, a.dilation, groups=2)
+        elif isinstance(a, (nn.BatchNorm1d, nn.BatchNorm2d)):
+            x = fused_batch_norm(a, b, x)
+        elif isinstance(a, nn.LeakyReLU):
+            x = a(x)
+        elif isinstance(a, nn.Identity):
+            pass
+        elif isinstance(a, Flatten):
+            x = x.view(batch_size, -1)
+        elif isinstance(a, nn.Linear):
+            '''(batch_size, 2*in_features) -> (2, batch_size, in_features) -> (batch_size, 2*out_features)'''
+            x = x.view(batch_size, 2, -1).transpose(0, 1)
+            x = torch.baddbmm(
+                torch.stack([a.bias, b.bias]).unsqueeze(1),
+                x,
+                torch.stack([a.weight, b.weight]).transpose(1, 2),
+            )
+            x = x.transpose(0, 1).contiguous().view(batch_size, -1)
+        else:
+            raise NotImplementedError('{} of {} can not be fused'.format(name, a))
+    x = x.view(batch_size, 2, -1)
+    return x[:,0], x[:,1]
+
+def recompute_without_batch_norm_update(model, function):
+    '''function, for torch.utils.checkpoint: the first call runs it as is, later
+    calls recompute it for backward, with the running statistics of the
+    BatchNorm layers of model left as they are'''
+    num_calls = [0]
+    def run(*inputs):
+        num_calls[0] += 1
+        if num_calls[0] == 1:
+            return function(*inputs)
+        batch_norms = [module for module in model.modules() if isinstance(module, (nn.BatchNorm1d, nn.BatchNorm2d))]
+        momentums = [batch_norm.momentum for batch_norm in batch_norms]
+        for batch_norm in batch_norms:
+            batch_norm.momentum = 0.0
+        try:
+            return function(*inputs)
+        finally:
+            for batch_norm, momentum in zip(batch_norms, momentums):
+                batch_norm.momentum = momentum
+    return run
+
 class BaseModel(nn.Module):
     def __init__(self):
         super(BaseModel, self).__init__()
-        self.zero_loss = torch.FloatTensor([0.0]).cuda()[0]
+        '''a buffer, so that it follows the model across devices; not stored'''
+        self.register_buffer('zero_loss', torch.zeros([]), persistent=False)
 
     def store(self, save_path):
         try:
@@ -285,7 +400,8 @@ class BaseModel(nn.Module):
 
     def restore(self, save_path):
         try:
-            self.load_state_dict(torch.load(save_path))
+            '''mapped to cpu, so that checkpoints of cuda runs restore anywhere, load_state_dict copies to the device of the model'''
+            self.load_state_dict(torch.load(save_path, map_location=torch.device('cpu')))
             print('# INFO: {}: Restore Successed.'.format(self.__class__.__name__))
         except Exception as e:
             print('# WARNING: {}: Restore Failed.'.format(self.__class__.__name__))
@@ -322,9 +438,17 @@ class GridModel(BaseModel):
         self.coordinates = {}
         self.relative_coordinates = {}
 
+        '''run the sibling Phi/Gamma branches as one in forward, see fused_sibling_branches'''
+        self.fused_branches = False
+
         self.coordinates_size = int((self.num_grid)**2)
         self.relative_coordinates_size = int((self.num_grid*2-1)**2)
 
+    def clear_batch_caches(self):
+        '''drop the tensors cached per batch_size, they are rebuilt on demand'''
+        self.coordinates = {}
+        self.relative_coordinates = {}
+
     def slice_grid(self, states, i, j):
         '''
         (batch_size, feature, height, width) -> (batch_size, feature, size_grid, size_grid)
@@ -363,7 +487,7 @@ class GridModel(BaseModel):
         (batch_size, each_grid, num_channels*self.size_grid**2) -> (batch_size, self.obs_size, self.obs_size)
         '''
         num_channels = int(states.size()[2]/(self.size_grid**2))
-        degrided_states = torch.FloatTensor(states.size()[0],num_channels,self.obs_size,self.obs_size).cuda()
+        degrided_states = torch.zeros(states.size()[0],num_channels,self.obs_size,self.obs_size,device=states.device)
         each_grid_i = 0
         for i in range(self.num_grid):
             for j in range(self.num_grid):
@@ -382,7 +506,7 @@ class GridModel(BaseModel):
             for i in range(self.num_grid):
                 for j in range(self.num_grid):
 
-                    temp = torch.zeros(batch_size,self.coordinates_size).cuda()
+                    temp = torch.zeros(batch_size,self.coordinates_size,device=states.device)
 
                     temp[:,(i*self.num_grid+j)].fill_(1.0)
 
@@ -402,7 +526,7 @@ class GridModel(BaseModel):
             for i in range(self.num_grid):
                 for j in range(self.num_grid):
 
-                    temp = torch.zeros(batch_size,self.relative_coordinates_size).cuda()
+                    temp = torch.zeros(batch_size,self.relative_coordinates_size,device=states.device)
 
                     for b in range(base_coordinates.size()[0]):
                         base_coordinate_tamp = base_coordinates[b].nonzero()[0,0].item()
@@ -524,6 +648,22 @@ class DirectControlModel(GridModel):
 
         self.NLLLoss = nn.NLLLoss(reduction='mean')
 
+        '''indices of the cells get_mask evaluates, None for all of them, see set_active_cells'''
+        self.register_buffer('active_cells', None, persistent=False)
+
+    def set_active_cells(self, mask):
+        '''make get_mask evaluate only the cells where mask (each_grid) is not
+        zero, the others get 0. The softmax over cells is then taken over the
+        active cells only, so that they still sum to one, in forward as well'''
+        active_cells = mask.view(-1).nonzero()[:,0]
+        if active_cells.size()[0] == mask.numel():
+            self.active_cells = None
+        else:
+            self.active_cells = active_cells.to(self.zero_loss.device)
+        print('# INFO: {}: get_mask evaluates {}/{} cells'.format(
+            self.__class__.__name__, active_cells.size()[0], mask.numel(),
+        ))
+
     def get_gamma(self, now_states, coordinates):
 
         '''(batch_size*from_each_grid, ...) -> (batch_size*from_each_grid, 1)'''
@@ -560,6 +700,28 @@ class DirectControlModel(GridModel):
 
         return phi
 
+    def get_gamma_phi_fused(self, now_last_states, now_states, coordinates):
+        '''get_gamma and get_phi, with Gamma_conv and Phi_conv (and the coordinate linears) run as one'''
+
+        '''Gamma_conv takes channel 1 of the input of Phi_conv'''
+        phi, gamma_bar = fused_sibling_branches(
+            self.Phi_conv, self.Gamma_conv,
+            torch.cat([now_last_states,now_states], dim=1),
+            b_input_channels = (1, 2),
+        )
+        phi_coordinates, gamma_coordinates = fused_sibling_linears(
+            self.Phi_coordinate_linear[0], self.Gamma_coordinate_linear[0], coordinates,
+        )
+
+        '''(batch_size*from_each_grid, ...) -> (batch_size, from_each_grid)'''
+        gamma_bar = self.extract_grid_axis_from_batch_axis(self.Gamma_output(gamma_bar*gamma_coordinates))
+        gamma = F.softmax(gamma_bar.squeeze(2), dim=1)
+
+        '''(batch_size*from_each_grid, ...) -> (batch_size, from_each_grid, self.action_space_n)'''
+        phi = self.extract_grid_axis_from_batch_axis(self.Phi_output(phi*phi_coordinates))
+
+        return gamma, phi
+
     def get_coordinates_now_states(self, now_states):
 
         '''(batch_size, ...) -> (batch_size*from_each_grid, ...)'''
@@ -577,6 +739,9 @@ class DirectControlModel(GridModel):
 
     def get_mask(self, now_states):
 
+        if self.active_cells is not None:
+            return self.get_mask_active_cells(now_states)
+
         '''(batch_size, ...) -> (batch_size*from_each_grid, ...)'''
         coordinates, now_states = self.get_coordinates_now_states(
             now_states = now_states,
@@ -590,6 +755,25 @@ class DirectControlModel(GridModel):
 
         return gamma
 
+    def get_mask_active_cells(self, now_states):
+        '''get_mask over self.active_cells only'''
+        batch_size = now_states.size()[0]
+
+        '''(batch_size, ...) -> (batch_size, active_grid, ...) -> (batch_size*active_grid, ...)'''
+        coordinates = self.put_grid_axis_to_batch_axis(self.get_absolute_coordinates(now_states)[:,self.active_cells])
+        now_states  = self.put_grid_axis_to_batch_axis(self.grid_states(now_states,is_flatten=False)[:,self.active_cells])
+
+        '''(batch_size*active_grid, ...) -> (batch_size, active_grid)'''
+        gamma_bar = self.Gamma_output(
+            self.Gamma_conv(now_states)
+            *
+            self.Gamma_coordinate_linear(coordinates)
+        ).view(batch_size, -1)
+        gamma = F.softmax(gamma_bar, dim=1)
+
+        '''(batch_size, active_grid) -> (batch_size, from_each_grid)'''
+        return gamma.new_zeros(batch_size, int(self.num_grid**2)).index_copy_(1, self.active_cells, gamma)
+
     def forward(self, last_states, now_states, action_lables):
 
         '''(batch_size, ...) -> (batch_size*from_each_grid, ...)'''
@@ -603,18 +787,34 @@ class DirectControlModel(GridModel):
             now_states = now_states,
         )
 
-        '''(batch_size*from_each_grid, ...) -> (batch_size, from_each_grid)'''
-        gamma = self.get_gamma(
-            now_states = now_states,
-            coordinates = coordinates,
-        )
+        if self.fused_branches:
+            gamma, phi = self.get_gamma_phi_fused(
+                now_last_states = now_last_states,
+                now_states = now_states,
+                coordinates = coordinates,
+            )
 
-        '''(batch_size*from_each_grid, ...) -> (batch_size, from_each_grid, self.action_space_n)'''
-        phi = self.get_phi(
-            now_last_states = now_last_states,
-            now_states = now_states,
-            coordinates = coordinates,
-        )
+        else:
+            '''(batch_size*from_each_grid, ...) -> (batch_size, from_each_grid)'''
+            gamma = self.get_gamma(
+                now_states = now_states,
+                coordinates = coordinates,
+            )
+
+            '''(batch_size*from_each_grid, ...) -> (batch_size, from_each_grid, self.action_space_n)'''
+            phi = self.get_phi(
+                now_last_states = now_last_states,
+                now_states = now_states,
+                coordinates = coordinates,
+            )
+
+        if self.active_cells is not None:
+            '''train gamma as get_mask_active_cells infers it: 0 on the inactive
+            cells, the softmax over the active cells only. The softmax over all
+            cells renormalized over the active ones is that softmax'''
+            active_gamma = gamma.index_select(1, self.active_cells)
+            active_gamma = active_gamma/active_gamma.sum(dim=1,keepdim=True)
+            gamma = gamma.new_zeros(gamma.size()).index_copy(1, self.active_cells, active_gamma)
 
         '''(batch_size, from_each_grid, self.action_space_n) and (batch_size, from_each_grid) -> (batch_size, self.action_space_n)'''
         predicted_action_log_probs = self.integrate_phi_gamma(phi,gamma)
@@ -642,17 +842,21 @@ class DirectControlModel(GridModel):
             loss_action_each = self.zero_loss
 
         if self.loss_action_entropy:
+            if self.active_cells is not None:
+                '''the inactive cells have 0 gamma, the entropy is over the active ones'''
+                gamma = active_gamma
+            num_cells = gamma.size()[1]
             '''(batch_size, from_each_grid) -> (batch_size*from_each_grid)'''
             gamma = self.put_grid_axis_to_batch_axis(gamma)
             '''(batch_size*from_each_grid) -> mean over batch_size'''
-            loss_ent_direct = self.get_gamma_entropy_loss(gamma)*(self.num_grid**2)
+            loss_ent_direct = self.get_gamma_entropy_loss(gamma)*num_cells
         else:
             loss_ent_direct = self.zero_loss
 
         return loss_action, loss_action_each, loss_ent_direct
 
 class LatentControlModel(GridModel):
-    def __init__(self, num_grid, num_stack, action_space_n, obs_size, ob_bound, model_structure, is_action_conditional, random_noise_frame=True, epsilon=1.0, C_keepsum=False, loss_transition_each=False, loss_transition_entropy=False):
+    def __init__(self, num_grid, num_stack, action_space_n, obs_size, ob_bound, model_structure, is_action_conditional, random_noise_frame=True, epsilon=1.0, C_keepsum=False, loss_transition_each=False, loss_transition_entropy=False, neighborhood_radius=None):
         super(LatentControlModel, self).__init__(num_grid, num_stack, action_space_n, obs_size)
 
         self.ob_bound = ob_bound
@@ -749,9 +953,85 @@ class LatentControlModel(GridModel):
         if self.random_noise_frame:
             self.noise_masks = {}
 
+        '''only the source cells within neighborhood_radius cells (on both axes)
+        of each target cell are evaluated, (2*r+1)**2 instead of num_grid**2 of
+        them. is_neighborhood can be switched off to evaluate all of them, with
+        the same parameters'''
+        self.neighborhood_radius = neighborhood_radius
+        self.is_neighborhood = neighborhood_radius is not None
+        self.neighbor_relative_coordinates = {}
+        if self.is_neighborhood:
+            self.build_neighborhood(neighborhood_radius)
+
+        '''rows per activation checkpoint of the Phi/Gamma trunks in training, None for no checkpointing, see run_rows'''
+        self.checkpoint_rows = None
+
+        '''bytes the activations of a (micro) batch may take, None for no limit, see get_micro_batch_size'''
+        self.memory_budget = None
+        self.row_bytes = None
+
+    def clear_batch_caches(self):
+        super(LatentControlModel, self).clear_batch_caches()
+        self.neighbor_relative_coordinates = {}
+        if self.random_noise_frame:
+            self.noise_masks = {}
+
+    def build_neighborhood(self, neighborhood_radius):
+        '''index tables of the (2*neighborhood_radius+1)**2 neighbor slots of
+        each to_each_grid, in to_each_grid-major order: the from_each_grid each
+        slot reads (0 for slots off the grid), whether the slot is on the grid,
+        and its relative coordinate'''
+        offsets = range(-neighborhood_radius, neighborhood_radius+1)
+        neighbor_index, neighbor_valid, neighbor_relative = [], [], []
+        for i in range(self.num_grid):
+            for j in range(self.num_grid):
+                for di in offsets:
+                    for dj in offsets:
+                        is_valid = (0 <= i+di < self.num_grid) and (0 <= j+dj < self.num_grid)
+                        neighbor_index += [(i+di)*self.num_grid+(j+dj) if is_valid else 0]
+                        neighbor_valid += [is_valid]
+                        neighbor_relative += [int((di+self.num_grid-1)*(self.num_grid*2-1)+(dj+self.num_grid-1))]
+        self.num_neighbor_slots = len(offsets)**2
+        '''(to_each_grid*from_each_grid)'''
+        self.register_buffer('neighbor_index'   , torch.LongTensor(neighbor_index)   , persistent=False)
+        self.register_buffer('neighbor_valid'   , torch.BoolTensor(neighbor_valid)   , persistent=False)
+        self.register_buffer('neighbor_relative', torch.LongTensor(neighbor_relative), persistent=False)
+
+    def get_num_from_grid(self):
+        '''size of the from_each_grid axis'''
+        if self.is_neighborhood:
+            return self.num_neighbor_slots
+        return int(self.num_grid**2)
+
+    def extract_from_grid_axis_from_batch_axis(self, x):
+        '''
+            (batch_size * from_each_grid, ...) -> (batch_size, from_each_grid, ...)
+        '''
+        num_from_grid = self.get_num_from_grid()
+        return x.view(int(x.size()[0]/num_from_grid),num_from_grid,*x.size()[1:])
+
+    def from_grid_softmax(self, gamma_bar):
+        '''softmax of (batch_size*to_each_grid, from_each_grid) over from_each_grid, slots off the grid get 0'''
+        if self.is_neighborhood:
+            gamma_bar = gamma_bar.masked_fill(
+                ~self.neighbor_valid.view(-1,self.num_neighbor_slots).repeat(int(gamma_bar.size()[0]/(self.num_grid**2)),1),
+                float('-inf'),
+            )
+        return F.softmax(gamma_bar, dim=1)
+
+    def get_neighbor_relative_coordinates(self, batch_size):
+        '''
+        -> (batch_size*to_each_grid*from_each_grid, self.relative_coordinates_size)
+        '''
+        if batch_size not in self.neighbor_relative_coordinates.keys():
+            self.neighbor_relative_coordinates[batch_size] = F.one_hot(
+                self.neighbor_relative, self.relative_coordinates_size,
+            ).float().repeat(batch_size,1)
+        return self.neighbor_relative_coordinates[batch_size]
+
     def randomize_noise_masks(self, batch_size):
         if batch_size not in self.noise_masks.keys():
-            self.noise_masks[batch_size] = torch.zeros(batch_size,1,self.obs_size,self.obs_size).cuda()
+            self.noise_masks[batch_size] = torch.zeros(batch_size,1,self.obs_size,self.obs_size,device=self.zero_loss.device)
         self.noise_masks[batch_size].uniform_(-1.0,1.0).sign_().mul_(self.epsilon)
 
     def add_noise_masks(self,x):
@@ -759,57 +1039,123 @@ class LatentControlModel(GridModel):
         x_return[:,-1:] = x_return[:,-1:] + self.noise_masks[x.size()[0]]
         return x_return
 
-    def get_gamma(self, last_states, coordinates, onehot_actions):
+    def run_rows(self, function, *rows):
+        '''function(*rows), rows sharing the batch axis. With checkpoint_rows
+        set and grad enabled, it is run as checkpoints of checkpoint_rows rows
+        each, so that only the inputs of each chunk are kept for backward and
+        the activations are recomputed. BatchNorm then normalizes each chunk
+        by its own statistics, and running statistics are not updated again by
+        the recompute'''
+        if (self.checkpoint_rows is None) or (not torch.is_grad_enabled()):
+            return function(*rows)
+        outputs = [
+            torch.utils.checkpoint.checkpoint(
+                recompute_without_batch_norm_update(self, function), *chunk, use_reentrant=False,
+            ) for chunk in zip(*[x.split(self.checkpoint_rows) for x in rows])
+        ]
+        if isinstance(outputs[0], tuple):
+            return tuple(torch.cat(output) for output in zip(*outputs))
+        return torch.cat(outputs)
+
+    def get_gamma_rows(self, last_states, coordinates, onehot_actions):
 
         '''(batch_size*to_each_grid*from_each_grid, ...) - > (batch_size*to_each_grid*from_each_grid, 1)'''
         if self.is_action_conditional:
-            gamma_bar = self.Gamma_output(
+            return self.Gamma_output(
                 self.Gamma_conv(last_states)
                 *
                 self.Gamma_coordinate_linear(coordinates)
                 *
-                self.Gamma_action_linear(onehot_actions)
+                embed_actions(self.Gamma_action_linear[0], onehot_actions, self.action_space_n)
             )
         else:
-            gamma_bar = self.Gamma_output(
+            return self.Gamma_output(
                 self.Gamma_conv(last_states)
                 *
                 self.Gamma_coordinate_linear(coordinates)
             )
 
+    def get_gamma(self, last_states, coordinates, onehot_actions):
+
+        '''(batch_size*to_each_grid*from_each_grid, ...) - > (batch_size*to_each_grid*from_each_grid, 1)'''
+        gamma_bar = self.run_rows(self.get_gamma_rows, last_states, coordinates, onehot_actions)
+
         '''(batch_size*to_each_grid*from_each_grid, 1)  -> (batch_size*to_each_grid, from_each_grid, 1)'''
-        gamma_bar = self.extract_grid_axis_from_batch_axis(gamma_bar)
+        gamma_bar = self.extract_from_grid_axis_from_batch_axis(gamma_bar)
 
         '''(batch_size*to_each_grid, from_each_grid, 1) -> (batch_size*to_each_grid, from_each_grid)'''
-        gamma     = F.softmax(gamma_bar.squeeze(2), dim=1)
+        gamma     = self.from_grid_softmax(gamma_bar.squeeze(2))
 
         return gamma
 
-    def get_phi(self, last_states, coordinates, onehot_actions):
+    def get_phi_rows(self, last_states, coordinates, onehot_actions):
 
         '''(batch_size*to_each_grid*from_each_grid, ...) - > (batch_size*to_each_grid*from_each_grid, ...)'''
         if self.is_action_conditional:
-            phi = self.Phi_deconv(
+            return self.Phi_deconv(
                 self.Phi_conv(last_states)
                 *
                 self.Phi_coordinate_linear(coordinates)
                 *
-                self.Phi_action_linear(onehot_actions)
+                embed_actions(self.Phi_action_linear[0], onehot_actions, self.action_space_n)
             )
         else:
-            phi = self.Phi_deconv(
+            return self.Phi_deconv(
                 self.Phi_conv(last_states)
                 *
                 self.Phi_coordinate_linear(coordinates)
             )
 
+    def get_phi(self, last_states, coordinates, onehot_actions):
+
+        '''(batch_size*to_each_grid*from_each_grid, ...) - > (batch_size*to_each_grid*from_each_grid, ...)'''
+        phi = self.run_rows(self.get_phi_rows, last_states, coordinates, onehot_actions)
+
         '''(batch_size*to_each_grid*from_each_grid, ...) - > (batch_size*to_each_grid, from_each_grid, ...)'''
-        phi = self.extract_grid_axis_from_batch_axis(phi)
+        phi = self.extract_from_grid_axis_from_batch_axis(phi)
 
         return phi
 
+    def get_phi_gamma_fused_rows(self, last_states, coordinates, onehot_actions):
+
+        phi, gamma_bar = fused_sibling_branches(self.Phi_conv, self.Gamma_conv, last_states)
+        phi_coordinates, gamma_coordinates = fused_sibling_linears(
+            self.Phi_coordinate_linear[0], self.Gamma_coordinate_linear[0], coordinates,
+        )
+        phi       = phi      *phi_coordinates
+        gamma_bar = gamma_bar*gamma_coordinates
+        if self.is_action_conditional:
+            phi_actions, gamma_actions = fused_sibling_linears(
+                self.Phi_action_linear[0], self.Gamma_action_linear[0], onehot_actions,
+            )
+            phi       = phi      *phi_actions
+            gamma_bar = gamma_bar*gamma_actions
+
+        return self.Phi_deconv(phi), self.Gamma_output(gamma_bar)
+
+    def get_phi_gamma_fused(self, last_states, coordinates, onehot_actions):
+        '''get_phi and get_gamma, with Phi_conv and Gamma_conv (and the coordinate and action linears) run as one'''
+
+        phi, gamma_bar = self.run_rows(self.get_phi_gamma_fused_rows, last_states, coordinates, onehot_actions)
+
+        '''(batch_size*to_each_grid*from_each_grid, ...) - > (batch_size*to_each_grid, from_each_grid, ...)'''
+        phi = self.extract_from_grid_axis_from_batch_axis(phi)
+
+        '''(batch_size*to_each_grid*from_each_grid, ...) - > (batch_size*to_each_grid, from_each_grid)'''
+        gamma_bar = self.extract_from_grid_axis_from_batch_axis(gamma_bar)
+        gamma     = self.from_grid_softmax(gamma_bar.squeeze(2))
+
+        return phi, gamma
+
     def get_coordinates_last_states_now_states_onehot_actions_now_states_target(self, now_states, last_states, onehot_actions):
 
+        if self.is_neighborhood:
+            return self.get_neighbor_coordinates_last_states_now_states_onehot_actions_now_states_target(
+                now_states = now_states,
+                last_states = last_states,
+                onehot_actions = onehot_actions,
+            )
+
         '''(batch_size, ...) -> (batch_size, to_each_grid, ...)'''
         base_coordinates = self.get_absolute_coordinates(now_states)
         now_states       = self.grid_states(now_states, is_flatten = False)
@@ -838,8 +1184,79 @@ class LatentControlModel(GridModel):
 
         return relative_coordinates, now_states, last_states, onehot_actions, now_states_target
 
-    def update_C(self, C, last_states, now_states, onehot_actions):
+    def get_neighbor_coordinates_last_states_now_states_onehot_actions_now_states_target(self, now_states, last_states, onehot_actions):
+        '''get_coordinates_last_states_now_states_onehot_actions_now_states_target
+        with from_each_grid restricted to the neighbor slots of each to_each_grid'''
+        batch_size = last_states.size()[0]
+        num_slots = self.neighbor_index.size()[0]
+
+        '''(batch_size, ...) -> (batch_size*to_each_grid, ...)'''
+        now_states        = self.put_grid_axis_to_batch_axis(self.grid_states(now_states, is_flatten = False))
+        now_states_target = self.flatten_cell(now_states)
+
+        '''(batch_size*to_each_grid, ...) -> (batch_size*to_each_grid*from_each_grid, ...)'''
+        now_states = self.put_grid_axis_to_batch_axis(self.repeat_on_each_grid_axis(now_states, self.num_neighbor_slots))
+
+        '''(batch_size, ...) -> (batch_size, to_each_grid*from_each_grid, ...) -> (batch_size*to_each_grid*from_each_grid, ...)'''
+        last_states          = self.put_grid_axis_to_batch_axis(self.grid_states(last_states, is_flatten=False)[:,self.neighbor_index])
+        onehot_actions       = self.put_grid_axis_to_batch_axis(self.repeat_on_each_grid_axis(onehot_actions, num_slots))
+        relative_coordinates = self.get_neighbor_relative_coordinates(batch_size)
 
+        return relative_coordinates, now_states, last_states, onehot_actions, now_states_target
+
+    def get_row_bytes(self):
+        '''estimated activation bytes of a batch*to_each_grid*from_each_grid
+        row through the Phi and Gamma trunks: the outputs of all their layers,
+        measured once on a probe of 2 rows, doubled for their gradients'''
+        if self.row_bytes is None:
+            row_bytes = [0]
+            def count(module, inputs, output):
+                if torch.is_tensor(output):
+                    row_bytes[0] += output[0].numel()*output.element_size()
+            hooks = [
+                module.register_forward_hook(count) for module in self.modules() if len(list(module.children()))==0
+            ]
+            device = self.zero_loss.device
+            last_states    = torch.zeros(2, self.num_stack, self.size_grid, self.size_grid, device=device)
+            coordinates    = torch.zeros(2, self.relative_coordinates_size, device=device)
+            onehot_actions = torch.zeros(2, self.action_space_n, device=device)
+            is_training = self.training
+            self.eval()
+            try:
+                with torch.no_grad():
+                    self.get_phi_rows(last_states, coordinates, onehot_actions)
+                    self.get_gamma_rows(last_states, coordinates, onehot_actions)
+            finally:
+                for hook in hooks:
+                    hook.remove()
+                self.train(is_training)
+            self.row_bytes = row_bytes[0]*2
+        return self.row_bytes
+
+    def get_micro_batch_size(self, batch_size):
+        '''samples per micro batch, so that the activations of their
+        batch*to_each_grid*from_each_grid rows fit memory_budget'''
+        if self.memory_budget is None:
+            return batch_size
+        rows_per_sample = int(self.num_grid**2)*self.get_num_from_grid()
+        return max(1, min(batch_size, int(self.memory_budget/(rows_per_sample*self.get_row_bytes()))))
+
+    def run_micro_batches(self, function, *batch):
+        '''function(*batch) in micro batches of get_micro_batch_size samples,
+        outputs concatenated on their first axis, for inference'''
+        batch_size = batch[0].size()[0]
+        micro_batch_size = self.get_micro_batch_size(batch_size)
+        if micro_batch_size >= batch_size:
+            return function(*batch)
+        outputs = [
+            function(*micro_batch) for micro_batch in zip(*[x.split(micro_batch_size) for x in batch])
+        ]
+        if isinstance(outputs[0], tuple):
+            return tuple(torch.cat(output) for output in zip(*outputs))
+        return torch.cat(outputs)
+
+    def add_update_C_noise(self, last_states, now_states):
+        '''the random part of update_C'''
         batch_size = last_states.size()[0]
 
         if self.random_noise_frame:
@@ -847,6 +1264,28 @@ class LatentControlModel(GridModel):
             now_states = self.add_noise_masks(now_states)
             last_states = self.add_noise_masks(last_states)
 
+        return last_states, now_states
+
+    def update_C(self, C, last_states, now_states, onehot_actions):
+
+        last_states, now_states = self.add_update_C_noise(
+            last_states = last_states,
+            now_states = now_states,
+        )
+
+        return self.update_C_deterministic(
+            C = C,
+            last_states = last_states,
+            now_states = now_states,
+            onehot_actions = onehot_actions,
+        )
+
+    def update_C_deterministic(self, C, last_states, now_states, onehot_actions):
+        '''update_C after the noise masks are added, traceable'''
+        return self.run_micro_batches(self.update_C_micro_batch, C, last_states, now_states, onehot_actions)
+
+    def update_C_micro_batch(self, C, last_states, now_states, onehot_actions):
+
         if self.C_keepsum:
             '''to one'''
             C_sum = C.sum(dim=1,keepdim=True).expand(C.size())
@@ -871,8 +1310,12 @@ class LatentControlModel(GridModel):
         '''(batch_size*to_each_grid, from_each_grid) -> (batch_size, to_each_grid, from_each_grid)'''
         gamma = self.extract_grid_axis_from_batch_axis(gamma)
 
-        '''(batch_size, from_each_grid) -> (batch_size, to_each_grid, from_each_grid)'''
-        C = self.repeat_on_each_grid_axis(C, int(self.num_grid**2))
+        if self.is_neighborhood:
+            '''(batch_size, each_grid) -> (batch_size, to_each_grid, from_each_grid)'''
+            C = C[:,self.neighbor_index].view(C.size()[0], int(self.num_grid**2), self.num_neighbor_slots)
+        else:
+            '''(batch_size, from_each_grid) -> (batch_size, to_each_grid, from_each_grid)'''
+            C = self.repeat_on_each_grid_axis(C, int(self.num_grid**2))
 
         '''(batch_size, to_each_grid, from_each_grid) -> (batch_size, to_each_grid)'''
         C = (C * gamma).sum(dim=2,keepdim=False)
@@ -885,6 +1328,19 @@ class LatentControlModel(GridModel):
         return C
 
     def get_predicted_now_states(self, last_states, now_states, onehot_actions):
+        '''
+            (batch_size, ...) ->
+            predicted_now_states: (batch_size*to_each_grid               , ...)
+            now_states_target:    (batch_size*to_each_grid               , ...)
+            gamma:                (batch_size*to_each_grid*from_each_grid, ...)
+            phi:                  (batch_size*to_each_grid*from_each_grid, ...)
+        in micro batches when no gradient is needed, forward is micro batched by the caller
+        '''
+        if torch.is_grad_enabled():
+            return self.get_predicted_now_states_micro_batch(last_states, now_states, onehot_actions)
+        return self.run_micro_batches(self.get_predicted_now_states_micro_batch, last_states, now_states, onehot_actions)
+
+    def get_predicted_now_states_micro_batch(self, last_states, now_states, onehot_actions):
 
         '''(batch_size, ...) -> (batch_size*to_each_grid*from_each_grid, ...)'''
         relative_coordinates, now_states, last_states, onehot_actions, now_states_target = self.get_coordinates_last_states_now_states_onehot_actions_now_states_target(
@@ -893,19 +1349,27 @@ class LatentControlModel(GridModel):
             onehot_actions = onehot_actions,
         )
 
-        '''(batch_size*to_each_grid*from_each_grid, ...) -> (batch_size*to_each_grid, from_each_grid, ...)'''
-        phi = self.get_phi(
-            last_states = last_states,
-            coordinates = relative_coordinates,
-            onehot_actions = onehot_actions,
-        )
+        if self.fused_branches:
+            phi, gamma = self.get_phi_gamma_fused(
+                last_states = last_states,
+                coordinates = relative_coordinates,
+                onehot_actions = onehot_actions,
+            )
 
-        '''(batch_size*to_each_grid*from_each_grid, ...)  -> (batch_size*to_each_grid, from_each_grid)'''
-        gamma = self.get_gamma(
-            last_states = last_states,
-            coordinates = relative_coordinates,
-            onehot_actions = onehot_actions,
-        )
+        else:
+            '''(batch_size*to_each_grid*from_each_grid, ...) -> (batch_size*to_each_grid, from_each_grid, ...)'''
+            phi = self.get_phi(
+                last_states = last_states,
+                coordinates = relative_coordinates,
+                onehot_actions = onehot_actions,
+            )
+
+            '''(batch_size*to_each_grid*from_each_grid, ...)  -> (batch_size*to_each_grid, from_each_grid)'''
+            gamma = self.get_gamma(
+                last_states = last_states,
+                coordinates = relative_coordinates,
+                onehot_actions = onehot_actions,
+            )
 
         '''(batch_size*to_each_grid, from_each_grid, ...) -> (batch_size*to_each_grid, ...)'''
         predicted_now_states = self.integrate_phi_gamma(phi, gamma)
@@ -950,9 +1414,13 @@ class LatentControlModel(GridModel):
 
         if self.loss_transition_each:
             '''(batch_size*to_each_grid, ...) -> (batch_size*to_each_grid, from_each_grid, ...)'''
-            now_states_target    = self.repeat_on_each_grid_axis(now_states_target, int(self.num_grid**2))
+            now_states_target    = self.repeat_on_each_grid_axis(now_states_target, self.get_num_from_grid())
             '''(batch_size*to_each_grid, from_each_grid, ...) -> (batch_size*to_each_grid*from_each_grid, ...)'''
             now_states_target    = self.put_grid_axis_to_batch_axis(now_states_target)
+            if self.is_neighborhood:
+                '''slots off the grid predict nothing'''
+                is_valid = self.neighbor_valid.repeat(batch_size)
+                phi, now_states_target = phi[is_valid], now_states_target[is_valid]
 
             '''(batch_size*to_each_grid*from_each_grid, ...) -> mean over batch_size*to_each_grid*from_each_grid '''
             loss_transition_each = F.mse_loss(
@@ -965,8 +1433,102 @@ class LatentControlModel(GridModel):
 
         if self.loss_transition_entropy:
             '''(batch_size*to_each_grid*from_each_grid) -> mean over batch_size*to_each_grid'''
-            loss_ent_latent = self.get_gamma_entropy_loss(gamma)*(self.num_grid**2)
+            if self.is_neighborhood:
+                '''slots off the grid have gamma 0'''
+                gamma = gamma[self.neighbor_valid.repeat(batch_size)]
+            loss_ent_latent = self.get_gamma_entropy_loss(gamma)*self.get_num_from_grid()
         else:
             loss_ent_latent = self.zero_loss
 
         return loss_transition, loss_transition_each, loss_ent_latent
+
+class GetMask(nn.Module):
+    """DirectControlModel.get_mask as a module, to be traced."""
+    def __init__(self, direct_control_model):
+        super(GetMask, self).__init__()
+        self.direct_control_model = direct_control_model
+
+    def forward(self, now_states):
+        return self.direct_control_model.get_mask(now_states)
+
+class UpdateC(nn.Module):
+    """LatentControlModel.update_C_deterministic as a module, to be traced."""
+    def __init__(self, latent_control_model):
+        super(UpdateC, self).__init__()
+        self.latent_control_model = latent_control_model
+
+    def forward(self, C, last_states, now_states, onehot_actions):
+        return self.latent_control_model.update_C_deterministic(C, last_states, now_states, onehot_actions)
+
+def trace_inference(module, example_inputs):
+    '''trace module for the shapes of example_inputs, and freeze its
+    parameters and BatchNorm statistics into the traced graph, so it has to
+    be traced again once the parameters change. Tensors cached per batch
+    size (coordinates) should be built before tracing, to become constants'''
+    module.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(module, example_inputs, check_trace=False)
+    traced = torch.jit.freeze(traced)
+    if hasattr(torch.jit, 'optimize_for_inference'):
+        traced = torch.jit.optimize_for_inference(traced)
+    return traced
+
+def fold_batch_norm_into(layer, batch_norm):
+    '''fold the eval-mode affine of batch_norm into the conv/linear layer before it'''
+    with torch.no_grad():
+        scale = batch_norm.weight / torch.sqrt(batch_norm.running_var + batch_norm.eps)
+        shape = [1]*layer.weight.dim()
+        '''output channels are dim 1 of a ConvTranspose2d weight, dim 0 otherwise'''
+        shape[1 if isinstance(layer, nn.ConvTranspose2d) else 0] = -1
+        bias = layer.bias if layer.bias is not None else torch.zeros_like(batch_norm.running_mean)
+        layer.weight.mul_(scale.view(shape))
+        layer.bias = nn.Parameter((bias - batch_norm.running_mean) * scale + batch_norm.bias)
+
+def fold_batch_norm(model):
+    '''inference copy of model, with every BatchNorm that follows a conv/linear
+    in an nn.Sequential folded into it and replaced by nn.Identity. The copy
+    does not follow later updates of model, it has to be folded again'''
+    folded = copy.deepcopy(model).eval()
+    for module in list(folded.modules()):
+        if isinstance(module, nn.Sequential):
+            names = list(module._modules.keys())
+            for name, next_name in zip(names[:-1], names[1:]):
+                if isinstance(module._modules[name], (nn.Conv2d, nn.ConvTranspose2d, nn.Linear)) and \
+                   isinstance(module._modules[next_name], (nn.BatchNorm1d, nn.BatchNorm2d)):
+                    fold_batch_norm_into(module._modules[name], module._modules[next_name])
+                    module._modules[next_name] = nn.Identity()
+    for parameter in folded.parameters():
+        parameter.requires_grad_(False)
+    return folded
+
+def quantize_for_inference(model, conv_branches, calibrate):
+    '''int8 CPU inference copy of model: BatchNorm folded (see fold_batch_norm),
+    the leading convs of each nn.Sequential named in conv_branches statically
+    quantized with observers calibrated by calibrate(quantized), and every
+    nn.Linear dynamically quantized. Like fold_batch_norm, it does not follow
+    later updates of model'''
+    quantized = fold_batch_norm(model).cpu()
+    quantized.clear_batch_caches()
+    qconfig = torch.quantization.get_default_qconfig(torch.backends.quantized.engine)
+    for branch_name in conv_branches:
+        branch = getattr(quantized, branch_name)
+        '''(conv, Identity, LeakyReLU)* before the flatten -> QuantStub, convs, DeQuantStub'''
+        modules = list(branch._modules.items())
+        num_convs = [isinstance(module, Flatten) for _, module in modules].index(True)
+        convs = nn.Sequential()
+        convs.add_module('quant', torch.quantization.QuantStub())
+        for name, module in modules[:num_convs]:
+            convs.add_module(name, module)
+        convs.add_module('dequant', torch.quantization.DeQuantStub())
+        convs.qconfig = qconfig
+        branch._modules.clear()
+        branch.add_module('convs', convs)
+        for name, module in modules[num_convs:]:
+            branch.add_module(name, module)
+    torch.quantization.prepare(quantized, inplace=True)
+    with torch.no_grad():
+        calibrate(quantized)
+    torch.quantization.convert(quantized, inplace=True)
+    torch.quantization.quantize_dynamic(quantized, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    quantized.clear_batch_caches()
+    return quantized
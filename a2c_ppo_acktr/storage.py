@@ -1,9 +1,10 @@
+import os
 import torch
 from torch.utils.data.sampler import BatchSampler, SubsetRandomSampler
 import numpy as np
 
 class PrioritizedReplayBuffer():
-    def __init__(self, size, mode, init_list, is_remove_inter_episode_transitions):
+    def __init__(self, size, mode, init_list, is_remove_inter_episode_transitions, device):
         """Create Prioritized Replay buffer.
         Parameters
         ----------
@@ -12,12 +13,15 @@ class PrioritizedReplayBuffer():
             overflows the memories of least priority are dropped.
         mode: str
             priority, random
+        device: torch.device
+            where the transitions are stored
         """
         super(PrioritizedReplayBuffer, self).__init__()
         self._maxsize = size
         self._max_priority = 0.0
         self.mode = mode
         self.is_remove_inter_episode_transitions = is_remove_inter_episode_transitions
+        self.device = device
 
         '''things to store'''
         self.storage = {}
@@ -146,7 +150,7 @@ class PrioritizedReplayBuffer():
             idxes = np.random.randint(low=0, high=self.priority.shape[0], size=batch_size, dtype=np.int64)
         else:
             raise NotImplemented
-        sampled = self.torch_sample_storage_by_idxes(self.storage, torch.from_numpy(idxes).cuda())
+        sampled = self.torch_sample_storage_by_idxes(self.storage, torch.from_numpy(idxes).to(self.device))
         return sampled, idxes
 
     def torch_sample_storage_by_idxes(self, to_sample, idxes):
@@ -196,7 +200,7 @@ class PrioritizedReplayBuffer():
             print('{}: Restoring {}.'.format(self.__class__.__name__,save_dir))
             loaded = np.load('{}.npy'.format(save_dir))
             for name in self.storage.keys():
-                self.storage[name] = torch.from_numpy(loaded[()][name]).cuda()
+                self.storage[name] = torch.from_numpy(loaded[()][name]).to(self.device)
             self.priority = np.squeeze(loaded[()][name],1)
             print('{}: Restore Successed, {} samples restored.'.format(self.__class__.__name__, self.storage[list(self.storage.keys())[0]].size()[0]))
         except Exception as e:
@@ -207,16 +211,20 @@ def _flatten_helper(T, N, _tensor):
 
 
 class RolloutStorage(object):
-    def __init__(self, num_steps, num_processes, obs_shape, action_space, recurrent_hidden_state_size):
+    def __init__(self, num_steps, num_processes, obs_shape, action_space, recurrent_hidden_state_size, index_actions=False):
         self.obs = torch.zeros(num_steps + 1, num_processes, *obs_shape)
         self.recurrent_hidden_states = torch.zeros(num_steps + 1, num_processes, recurrent_hidden_state_size)
         self.rewards = torch.zeros(num_steps, num_processes, 1)
         self.value_preds = torch.zeros(num_steps + 1, num_processes, 1)
         self.returns = torch.zeros(num_steps + 1, num_processes, 1)
         self.action_log_probs = torch.zeros(num_steps, num_processes, 1)
+        '''the control models take the action indices in self.actions if
+        index_actions, self.onehot_actions otherwise, see get_control_actions'''
+        self.index_actions = index_actions
         if action_space.__class__.__name__ == 'Discrete':
             action_shape = 1
-            self.onehot_actions = torch.zeros(num_steps, num_processes, action_space.n)
+            if not self.index_actions:
+                self.onehot_actions = torch.zeros(num_steps, num_processes, action_space.n)
         else:
             action_shape = action_space.shape[0]
         self.actions = torch.zeros(num_steps, num_processes, action_shape)
@@ -226,6 +234,8 @@ class RolloutStorage(object):
 
         self.num_steps = num_steps
         self.step = 0
+        '''per-env step, for envs that are stepped asynchronously'''
+        self.env_steps = torch.zeros(num_processes).long()
 
     def put_process_axis_into_batch_axis(self, x):
         return x.view(x.size()[0]*x.size()[1], *x.size()[2:])
@@ -238,13 +248,21 @@ class RolloutStorage(object):
         self.returns = self.returns.to(device)
         self.action_log_probs = self.action_log_probs.to(device)
         self.actions = self.actions.to(device)
-        self.onehot_actions = self.onehot_actions.to(device)
+        if hasattr(self, 'onehot_actions'):
+            self.onehot_actions = self.onehot_actions.to(device)
         self.masks = self.masks.to(device)
 
 
     def insert_1(self, actions):
         self.actions[self.step].copy_(actions)
-        self.onehot_actions[self.step].fill_(0.0).scatter_(1,self.actions[self.step],1.0)
+        if hasattr(self, 'onehot_actions'):
+            self.onehot_actions[self.step].fill_(0.0).scatter_(1,self.actions[self.step],1.0)
+
+    def get_control_actions(self):
+        '''(num_steps, num_processes, ...) actions as the control models take them'''
+        if self.index_actions:
+            return self.actions
+        return self.onehot_actions
 
     def insert_2(self, obs, recurrent_hidden_states, action_log_probs, value_preds, rewards, masks):
         self.obs[self.step + 1].copy_(obs)
@@ -256,10 +274,34 @@ class RolloutStorage(object):
 
         self.step = (self.step + 1) % self.num_steps
 
+    def get_async(self, env_ids):
+        '''obs, recurrent_hidden_states and masks the given envs are to act on'''
+        steps = self.env_steps[env_ids]
+        return self.obs[steps, env_ids], self.recurrent_hidden_states[steps, env_ids], self.masks[steps, env_ids]
+
+    def insert_async(self, env_ids, obs, recurrent_hidden_states, actions, action_log_probs, value_preds, rewards, masks):
+        '''insert_1 and insert_2 for the given envs only, each at its own step'''
+        steps = self.env_steps[env_ids]
+        self.actions[steps, env_ids] = actions
+        if hasattr(self, 'onehot_actions'):
+            self.onehot_actions[steps, env_ids] = self.onehot_actions.new_zeros(
+                len(env_ids), self.onehot_actions.size()[2]).scatter_(1, actions, 1.0)
+        self.obs[steps + 1, env_ids] = obs
+        self.recurrent_hidden_states[steps + 1, env_ids] = recurrent_hidden_states
+        self.action_log_probs[steps, env_ids] = action_log_probs
+        self.value_preds[steps, env_ids] = value_preds
+        self.rewards[steps, env_ids] = rewards.to(self.rewards.device)
+        self.masks[steps + 1, env_ids] = masks
+        self.env_steps[env_ids] += 1
+
+    def is_full(self):
+        return bool((self.env_steps>=self.num_steps).all())
+
     def after_update(self):
         self.obs[0].copy_(self.obs[-1])
         self.recurrent_hidden_states[0].copy_(self.recurrent_hidden_states[-1])
         self.masks[0].copy_(self.masks[-1])
+        self.env_steps.zero_()
 
     def compute_returns(self, next_value, use_gae, gamma, tau):
         if use_gae:
@@ -354,3 +396,68 @@ class RolloutStorage(object):
 
             yield obs_batch, recurrent_hidden_states_batch, actions_batch, \
                 value_preds_batch, return_batch, masks_batch, old_action_log_probs_batch, adv_targ
+
+class TrajectoryTransitionDataset(torch.utils.data.Dataset):
+    """Transitions of trajectories recorded by VecTrajectoryRecorder, in the
+    layout pushed to PrioritizedReplayBuffer by main.py. States are stacked
+    from the memory-mapped frames on the fly, as VecPyTorchFrameStack does,
+    and returned as uint8, to be normalized by ObsNorm on the device."""
+    def __init__(self, trajectory_dirs, num_stack, G_skip, is_remove_inter_episode_transitions):
+        super(TrajectoryTransitionDataset, self).__init__()
+        self.trajectory_dirs = trajectory_dirs
+        self.num_stack = num_stack
+        self.G_skip = G_skip
+        self.arrays = None
+
+        '''(trajectory, step, process) of every transition'''
+        self.indexes = []
+        for i, trajectory_dir in enumerate(self.trajectory_dirs):
+            dones = self.load(trajectory_dir)['dones']
+            num_steps, num_processes = dones.shape
+            step, process = np.meshgrid(np.arange(num_steps-self.G_skip+1), np.arange(num_processes), indexing='ij')
+            index = np.stack([np.full(step.size, i), step.flatten(), process.flatten()], 1)
+            if is_remove_inter_episode_transitions:
+                index = index[np.logical_not(dones[index[:,1], index[:,2]])]
+            self.indexes += [index]
+        self.indexes = np.concatenate(self.indexes)
+
+    def load(self, trajectory_dir):
+        import json
+        with open(os.path.join(trajectory_dir, 'meta.json'), 'r') as f:
+            num_steps = json.load(f)['num_steps']
+        arrays = {}
+        for name in ['frames', 'actions', 'dones']:
+            arrays[name] = np.load(os.path.join(trajectory_dir, '{}.npy'.format(name)), mmap_mode='r')
+        arrays['frames'] = arrays['frames'][:num_steps+1]
+        arrays['actions'] = arrays['actions'][:num_steps]
+        arrays['dones'] = arrays['dones'][:num_steps]
+        return arrays
+
+    def __len__(self):
+        return self.indexes.shape[0]
+
+    def get_states(self, frames, dones, step, process):
+        '''stack num_stack frames up to step, frames of previous episodes are zeros'''
+        states = np.zeros((self.num_stack,)+frames.shape[3:], dtype=np.uint8)
+        for k in range(self.num_stack):
+            frame_step = step-self.num_stack+1+k
+            if (frame_step >= 0) and (not dones[frame_step:step, process].any()):
+                states[k] = frames[frame_step, process, 0]
+        return states
+
+    def __getitem__(self, index):
+        '''memmaps are opened in each DataLoader worker'''
+        if self.arrays is None:
+            self.arrays = [self.load(trajectory_dir) for trajectory_dir in self.trajectory_dirs]
+        trajectory, step, process = self.indexes[index]
+        frames, actions, dones = self.arrays[trajectory]['frames'], self.arrays[trajectory]['actions'], self.arrays[trajectory]['dones']
+
+        transition = {
+            'states'             : torch.from_numpy(self.get_states(frames, dones, step, process)),
+            'actions'            : torch.LongTensor([actions[step, process]]),
+            'next_states'        : torch.from_numpy(np.array(frames[step+1, process])),
+            'next_state_masks'   : torch.FloatTensor([0.0 if dones[step, process] else 1.0]),
+        }
+        if self.G_skip>1:
+            transition['skipped_next_states'] = torch.from_numpy(np.array(frames[step+self.G_skip, process]))
+        return transition
@@ -1,9 +1,11 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from a2c_ppo_acktr.envs import VecNormalize
+from a2c_ppo_acktr.envs import VecNormalize, get_vec_episode_stats
 import tensorflow as tf
 import os
+import copy
+import queue
 import numpy as np
 import cv2
 import torch
@@ -95,38 +97,102 @@ def clear_print(string_to_print):
     clear_print_line()
     print(string_to_print,end="\r")
 
+class StreamingMeanStd(object):
+    """Element-wise mean and std over a stream of batches with O(1) memory.
+    Batches are merged with the parallel algorithm of Chan et al., see
+    https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
+    """
+    def __init__(self):
+        super(StreamingMeanStd, self).__init__()
+        self.mean = None
+        self.M2 = None
+        self.count = 0
+
+    def update(self, x):
+        '''x: torch.Tensor(batch, ...)'''
+        x = x.double()
+        batch_count = x.size()[0]
+        batch_mean = x.mean(dim=0)
+        batch_M2 = (x-batch_mean).pow(2).sum(dim=0)
+        if self.mean is None:
+            self.mean, self.M2, self.count = batch_mean, batch_M2, batch_count
+        else:
+            delta = batch_mean-self.mean
+            count = self.count+batch_count
+            self.mean = self.mean + delta*(batch_count/count)
+            self.M2 = self.M2 + batch_M2 + delta.pow(2)*(self.count*batch_count/count)
+            self.count = count
+
+    def get_std(self):
+        '''unbiased, same as torch.std'''
+        return (self.M2/(self.count-1)).sqrt()
+
+def get_obs_norm_cache_key(args):
+    '''obs statistics of a random agent only depend on the game and on how frames are preprocessed'''
+    key = 'en-{}'.format(args.env_name)
+    key += '_os-{}'.format(args.obs_size)
+    key += '_at-{}'.format(args.add_timestep)
+    if args.crop_obs is not None:
+        key += '_co-{}-{}-{}-{}-{}'.format(
+            args.crop_obs['mode'],
+            args.crop_obs['h'][0], args.crop_obs['h'][1],
+            args.crop_obs['w'][0], args.crop_obs['w'][1],
+        )
+    if args.fused_preprocess:
+        key += '_fp'
+    return key
+
 class ObsNorm(object):
     """docstring for ObsNorm."""
-    def __init__(self, envs, num_processes, nsteps):
+    def __init__(self, make_envs, num_processes, nsteps, device, cache_dir=None, release_envs=None):
         super(ObsNorm, self).__init__()
-        self.envs = envs
+        self.make_envs = make_envs
+        self.device = device
+        self.release_envs = release_envs
         self.num_processes = num_processes
         self.nsteps = nsteps
+        self.cache_dir = cache_dir
 
     def random_agent_ob_mean_std(self):
 
-        obs = self.envs.reset()[:,-1:].cpu()
+        envs = self.make_envs()
+
+        ob_mean_std = StreamingMeanStd()
+        ob_mean_std.update(envs.reset()[:,-1:].cpu())
 
-        action = torch.LongTensor(self.num_processes,1).cuda()
+        action = torch.LongTensor(self.num_processes,1).to(self.device)
 
         for i in range(self.nsteps):
             clear_print('# INFO: Running ObsNorm [{}/{}]'.format(i,self.nsteps))
-            action.random_(0, self.envs.action_space.n)
-            obs_new = self.envs.step(action)[0][:,-1:].cpu()
-            obs = torch.cat(
-                [obs,obs_new],
-                dim=0,
-            )
+            action.random_(0, envs.action_space.n)
+            ob_mean_std.update(envs.step(action)[0][:,-1:].cpu())
+
+        if self.release_envs is not None:
+            self.release_envs(envs)
+        else:
+            envs.close()
 
         self.ob_mean = to_batch_version(
-            obs.mean(dim=0, keepdim=True).cuda(),
+            ob_mean_std.mean.float().unsqueeze(0).to(self.device),
             self.num_processes,
         )
-        self.ob_std = obs.std(dim=0).mean().item()
+        self.ob_std = ob_mean_std.get_std().mean().item()
         self.ob_bound = 255.0/self.ob_std
 
+        if self.cache_dir is not None:
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                pass
+            self.store(self.cache_dir)
+
+    def resize(self, num_processes):
+        self.num_processes = num_processes
+        self.ob_mean = to_batch_version(self.ob_mean[:1], self.num_processes)
+
     def obs_norm_batch(self, obs):
-        return ((obs-self.ob_mean)/self.ob_std)
+        '''obs may be a subset of the envs, when they are stepped asynchronously'''
+        return ((obs-self.ob_mean[:obs.size()[0]])/self.ob_std)
 
     def obs_denorm_single(self, obs):
         return ((obs*self.ob_std)+self.ob_mean[0][-1:])
@@ -134,15 +200,27 @@ class ObsNorm(object):
     def obs_display_norm_single(self, obs):
         return ((obs*self.ob_std)+255.0)/2.0
 
+    def load(self, log_dir):
+        '''ob_mean may be stored by a run with another num_processes'''
+        self.ob_mean = to_batch_version(
+            torch.from_numpy(np.load(log_dir+'/ob_mean.npy'))[:1].to(self.device),
+            self.num_processes,
+        )
+        self.ob_std = np.load(log_dir+'/ob_std.npy')[0]
+        self.ob_bound = np.load(log_dir+'/ob_bound.npy')[0]
+
     def restore(self, log_dir):
         try:
-            self.ob_mean = torch.from_numpy(np.load(log_dir+'/ob_mean.npy')).cuda()
-            self.ob_std = np.load(log_dir+'/ob_std.npy')[0]
-            self.ob_bound = np.load(log_dir+'/ob_bound.npy')[0]
+            self.load(log_dir)
             print('# INFO: Restore ObsNorm: Successed.')
         except Exception as e:
             print('# WARNING: Restore ObsNorm: Failed')
-            self.random_agent_ob_mean_std()
+            try:
+                self.load(self.cache_dir)
+                print('# INFO: Restore ObsNorm from cache {}: Successed.'.format(self.cache_dir))
+            except Exception as e:
+                print('# WARNING: Restore ObsNorm from cache: Failed')
+                self.random_agent_ob_mean_std()
         print('# INFO: Estimated mean shape {}; std {} bound {}'.format(
             self.ob_mean.size(),
             self.ob_std,
@@ -502,8 +580,9 @@ class VideoSummary(object):
                 self.reset_summary()
 
 class RunningBinaryNorm():
-    def __init__(self):
+    def __init__(self, device):
         """SimHashCountBouns"""
+        self.device = device
         self.mean = None
         self.count = 0
         self.check_data_type()
@@ -549,7 +628,7 @@ class RunningBinaryNorm():
         try:
             loaded = np.load('{}.npy'.format(save_dir))
             self.count = loaded[()]['count'][0]
-            self.mean = torch.from_numpy(loaded[()]['mean']).cuda()
+            self.mean = torch.from_numpy(loaded[()]['mean']).to(self.device)
             print('# INFO: {} restore Successed. Restore {}.'.format(self.__class__.__name__,loaded[()]))
         except Exception as e:
             print('# WARNING: restore Failed.'.format(self.__class__.__name__))
@@ -557,19 +636,20 @@ class RunningBinaryNorm():
         self.check_data_type()
 
 class SimHashCountBouns():
-    def __init__(self, D, k, batch_size):
+    def __init__(self, D, k, batch_size, device):
         """SimHashCountBouns"""
 
+        self.device = device
         self.D = D
         self.k = k
         self.batch_size = batch_size
         self.m = 2
 
         '''to be build according to batch_size'''
-        A = torch.FloatTensor(1,self.D,self.k).normal_(mean=0.0, std=1.0).cuda()
+        A = torch.FloatTensor(1,self.D,self.k).normal_(mean=0.0, std=1.0).to(self.device)
         bin_to_hex = torch.from_numpy(
             self.m**np.arange(self.k)
-        ).unsqueeze(0).cuda()
+        ).unsqueeze(0).to(self.device)
         self.As          = to_batch_version(A         , batch_size)
         self.bin_to_hexs = to_batch_version(bin_to_hex, batch_size)
 
@@ -588,6 +668,12 @@ class SimHashCountBouns():
         assert self.bin_to_hexs.dtype == torch.long
         assert self.count.dtype == torch.long
 
+    def resize(self, batch_size):
+        '''rebatch the hash, count is kept'''
+        self.batch_size = batch_size
+        self.As          = to_batch_version(self.As[:1]         , batch_size)
+        self.bin_to_hexs = to_batch_version(self.bin_to_hexs[:1], batch_size)
+
     def get_bouns(self, states, keepdim, is_stack):
 
         '''SimHash'''
@@ -609,7 +695,7 @@ class SimHashCountBouns():
         bouns =  self.count.gather(
             0,
             indexes.cpu(),
-        ).cuda().float().pow(0.5).reciprocal()
+        ).to(self.device).float().pow(0.5).reciprocal()
 
         if keepdim:
             bouns = bouns.unsqueeze(1)
@@ -634,8 +720,8 @@ class SimHashCountBouns():
     def restore(self, save_dir):
         try:
             loaded = np.load('{}.npy'.format(save_dir))
-            self.As = torch.from_numpy(loaded[()]['As']).cuda()
-            self.bin_to_hexs = torch.from_numpy(loaded[()]['bin_to_hexs']).cuda()
+            self.As = torch.from_numpy(loaded[()]['As']).to(self.device)
+            self.bin_to_hexs = torch.from_numpy(loaded[()]['bin_to_hexs']).to(self.device)
             # self.count = torch.from_numpy(loaded[()]['count']).cpu()
             print('# INFO: {} restore Successed, self.count: {}.'.format(self.__class__.__name__,self.count.size()))
         except Exception as e:
@@ -644,7 +730,8 @@ class SimHashCountBouns():
         self.check_data_type()
 
 class HardHashCountBouns():
-    def __init__(self, k, m, batch_size):
+    def __init__(self, k, m, batch_size, device):
+        self.device = device
         self.k = k
         self.m = m
         self.batch_size = batch_size
@@ -652,7 +739,7 @@ class HardHashCountBouns():
         '''to be build according to batch_size'''
         bin_to_hex = torch.from_numpy(
             self.m**np.arange(self.k)
-        ).unsqueeze(0).cuda()
+        ).unsqueeze(0).to(self.device)
         self.bin_to_hexs = to_batch_version(bin_to_hex, batch_size)
 
         '''count is maitained in cpu to save gpu memory'''
@@ -670,6 +757,11 @@ class HardHashCountBouns():
         assert self.bin_to_hexs.dtype == torch.long
         assert self.count.dtype == torch.long
 
+    def resize(self, batch_size):
+        '''rebatch the hash, count is kept'''
+        self.batch_size = batch_size
+        self.bin_to_hexs = to_batch_version(self.bin_to_hexs[:1], batch_size)
+
     def get_bouns(self, states, keepdim, is_stack):
 
         '''HardHash'''
@@ -687,7 +779,7 @@ class HardHashCountBouns():
         bouns =  self.count.gather(
             0,
             indexes.cpu(),
-        ).cuda().float().pow(0.5).reciprocal()
+        ).to(self.device).float().pow(0.5).reciprocal()
 
         if keepdim:
             bouns = bouns.unsqueeze(1)
@@ -718,8 +810,9 @@ class HardHashCountBouns():
         self.check_data_type()
 
 class IndexHashCountBouns():
-    def __init__(self, k, batch_size, count_data_type, is_normalize):
+    def __init__(self, k, batch_size, count_data_type, is_normalize, device):
         """IndexHashCountBouns"""
+        self.device = device
         self.k = k
         self.batch_size = batch_size
         self.count_data_type = count_data_type
@@ -727,7 +820,7 @@ class IndexHashCountBouns():
 
         self.count = torch.Tensor(
             1,int(self.k**2)
-        ).cuda().fill_(0)
+        ).to(self.device).fill_(0)
         if self.count_data_type in ['long']:
             self.count = self.count.long().fill_(1)
         elif self.count_data_type in ['double']:
@@ -747,6 +840,10 @@ class IndexHashCountBouns():
         else:
             raise NotImplemented
 
+    def resize(self, batch_size):
+        '''count is shared by the whole batch, nothing to rebatch'''
+        self.batch_size = batch_size
+
     def get_bouns_map(self):
         bouns_map = self.count.double().pow(0.5).reciprocal().float()
         if self.is_normalize:
@@ -788,7 +885,7 @@ class IndexHashCountBouns():
     def restore(self, log_dir):
         try:
             loaded = np.load('{}.npy'.format(log_dir))
-            self.count = torch.from_numpy(loaded[()]['count']).cuda()
+            self.count = torch.from_numpy(loaded[()]['count']).to(self.device)
             print('{}: Restore Successed, self.count: {}.'.format(self.__class__.__name__,self.count))
         except Exception as e:
             print('{}: Restore Failed.'.format(self.__class__.__name__))
@@ -813,10 +910,10 @@ class DirectControlMask(object):
             ),
         )
         try:
-            mask = torch.from_numpy(self.read_grid_map(path)).float().cuda()
+            mask = torch.from_numpy(self.read_grid_map(path)).float().to(args.device)
         except Exception as e:
             print('# WARNING: No direct_control_mask loaded, as default')
-            mask = torch.ones(self.args.num_grid,self.args.num_grid).float().cuda()
+            mask = torch.ones(self.args.num_grid,self.args.num_grid).float().to(args.device)
         assert mask.size()[0]==args.num_grid and mask.size()[1]==args.num_grid
 
         '''add batch dim'''
@@ -826,6 +923,9 @@ class DirectControlMask(object):
 
         self.mask_batch = to_batch_version(mask,args.num_processes)
 
+    def resize(self, num_processes):
+        self.mask_batch = to_batch_version(self.mask_batch[:1],num_processes)
+
     def mask(self, x):
         return x*self.mask_batch
 
@@ -881,7 +981,7 @@ class TF_Summary(object):
                 pass
 
 
-def store_learner(args, actor_critic, envs, j):
+def store_learner(args, actor_critic, envs, j, num_trained_frames=None):
     import copy
     from a2c_ppo_acktr.utils import get_vec_normalize
     '''store learner'''
@@ -897,15 +997,20 @@ def store_learner(args, actor_critic, envs, j):
             os.path.join(args.log_dir, "j.npy"),
             np.array([j]),
         )
+        if num_trained_frames is not None:
+            '''num_processes may change during training, so the frames are not j*num_processes*num_steps'''
+            np.save(
+                os.path.join(args.log_dir, "num_trained_frames.npy"),
+                np.array([num_trained_frames, args.num_processes]),
+            )
         print('# INFO: store learner ok.')
     except Exception as e:
         print('# WARNING: store learner failed: {}.'.format(e))
 
 def restore_learner(args, actor_critic, envs, j):
     try:
-        actor_critic, ob_rms = torch.load(os.path.join(args.log_dir, 'learner' + ".pt"))
-        if args.cuda:
-            actor_critic = actor_critic.cuda()
+        actor_critic, ob_rms = torch.load(os.path.join(args.log_dir, 'learner' + ".pt"), map_location=torch.device('cpu'))
+        actor_critic = actor_critic.to(args.device)
         envs.ob_rms = ob_rms
         j = np.load(
             os.path.join(args.log_dir, "j.npy"),
@@ -916,6 +1021,150 @@ def restore_learner(args, actor_critic, envs, j):
 
     return actor_critic, envs, j
 
+def restore_num_trained_frames(args):
+    '''num_trained_frames stored by store_learner, None if there is none.
+    args.num_processes is set back to the num_processes it was stored with'''
+    try:
+        num_trained_frames, num_processes = np.load(
+            os.path.join(args.log_dir, "num_trained_frames.npy"),
+        )
+        if num_processes != args.num_processes:
+            print('# INFO: num_processes {} -> {}, as stored'.format(args.num_processes, num_processes))
+        args.num_processes = int(num_processes)
+        print('# INFO: restore num_trained_frames ok.')
+        return int(num_trained_frames)
+    except Exception as e:
+        print('# WARNING: restore num_trained_frames failed: {}.'.format(e))
+        return None
+
+def evaluate_episodes(eval_envs, actor_critic, obs_norm_batch, eval_steps, device):
+    '''run the deterministic policy until eval_steps episodes finish, return the mean episode reward'''
+    num_processes = eval_envs.num_envs
+
+    eval_episode_rewards = []
+
+    obs = eval_envs.reset()
+    obs = obs_norm_batch(obs)
+    eval_recurrent_hidden_states = torch.zeros(num_processes,
+                    actor_critic.recurrent_hidden_state_size, device=device)
+    eval_masks = torch.zeros(num_processes, 1, device=device)
+
+    while len(eval_episode_rewards) < eval_steps:
+        with torch.no_grad():
+            _, action, _, eval_recurrent_hidden_states = actor_critic.act(
+                obs, eval_recurrent_hidden_states, eval_masks, deterministic=True)
+
+        # Obser reward and next obs
+        obs, reward, done, infos = eval_envs.step(action)
+        obs = obs_norm_batch(obs)
+
+        eval_masks = torch.FloatTensor([[0.0] if done_ else [1.0]
+                                        for done_ in done]).to(device)
+        episode_returns = get_vec_episode_stats(eval_envs).get_episode_returns()
+        if len(episode_returns)>0:
+            eval_episode_rewards.extend(episode_returns)
+            clear_print("# INFO: [Evaluate {} episodes] [eval_ex_raw: {}]".format(
+                len(eval_episode_rewards),
+                eval_episode_rewards[-1],
+            ))
+
+    return np.mean(eval_episode_rewards)
+
+def async_evaluate_worker(make_vec_envs_kwargs, actor_critic, shared_state_dict, ob_mean, ob_std, eval_steps, lock, snapshot_queue, result_queue):
+    '''keep an eval env pool alive and evaluate every policy snapshot received'''
+    torch.set_num_threads(1)
+    device = torch.device('cpu')
+
+    from a2c_ppo_acktr.envs import make_vec_envs
+    eval_envs = make_vec_envs(device=device, **make_vec_envs_kwargs)
+
+    def obs_norm_batch(obs):
+        return ((obs-ob_mean)/ob_std)
+
+    while True:
+        num_trained_frames = snapshot_queue.get()
+        with lock:
+            '''skip to the latest snapshot if the learner is ahead'''
+            while True:
+                try:
+                    num_trained_frames = snapshot_queue.get_nowait()
+                except queue.Empty:
+                    break
+            if num_trained_frames is None:
+                break
+            actor_critic.load_state_dict(shared_state_dict)
+        eval_ex_raw = evaluate_episodes(eval_envs, actor_critic, obs_norm_batch, eval_steps, device)
+        result_queue.put((num_trained_frames, eval_ex_raw))
+
+    eval_envs.close()
+
+class AsyncEvaluator(object):
+    """Evaluate policy snapshots in a background process, so that evaluation
+    never blocks the learner. Weights are handed over through a CPU copy of
+    the policy in shared memory, the process keeps its own eval env pool."""
+    '''seconds close() waits for an evaluation in flight before terminating it'''
+    close_timeout = 10.0
+
+    def __init__(self, actor_critic, make_vec_envs_kwargs, ob_mean, ob_std, eval_steps):
+        super(AsyncEvaluator, self).__init__()
+        import torch.multiprocessing as mp
+        '''spawn, as forking a parent that may have initialized cuda or tensorflow is
+        unsafe. The worker re-imports the main script, which keeps its side effects
+        under if __name__ == '__main__', and only gets cpu tensors'''
+        ctx = mp.get_context('spawn')
+
+        actor_critic = copy.deepcopy(actor_critic).cpu()
+        self.shared_state_dict = {name: tensor.clone().share_memory_() for name, tensor in actor_critic.state_dict().items()}
+
+        self.lock = ctx.Lock()
+        self.snapshot_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+
+        self.process = ctx.Process(
+            target = async_evaluate_worker,
+            kwargs = dict(
+                make_vec_envs_kwargs = make_vec_envs_kwargs,
+                actor_critic = actor_critic,
+                shared_state_dict = self.shared_state_dict,
+                ob_mean = ob_mean.cpu(),
+                ob_std = ob_std,
+                eval_steps = eval_steps,
+                lock = self.lock,
+                snapshot_queue = self.snapshot_queue,
+                result_queue = self.result_queue,
+            ),
+        )
+        self.process.start()
+
+        import atexit
+        atexit.register(self.close)
+
+    def submit(self, actor_critic, num_trained_frames):
+        with self.lock:
+            for name, tensor in actor_critic.state_dict().items():
+                self.shared_state_dict[name].copy_(tensor)
+            self.snapshot_queue.put(num_trained_frames)
+
+    def get_results(self):
+        '''[(num_trained_frames, eval_ex_raw), ...] finished since the last call'''
+        results = []
+        while True:
+            try:
+                results += [self.result_queue.get_nowait()]
+            except queue.Empty:
+                break
+        return results
+
+    def close(self):
+        if self.process is not None:
+            self.snapshot_queue.put(None)
+            self.process.join(self.close_timeout)
+            if self.process.is_alive():
+                print('# WARNING: AsyncEvaluator: evaluation still running after {}s, terminated'.format(self.close_timeout))
+                self.process.terminate()
+                self.process.join()
+            self.process = None
+
 # Get a render function
 def get_render_func(venv):
     if hasattr(venv, 'envs'):
@@ -951,6 +1200,68 @@ class AddBias(nn.Module):
 
         return x + bias
 
+def read_num_processes(path, num_processes):
+    '''number of env workers requested in the file at path, num_processes if there is none'''
+    try:
+        with open(path, 'r') as f:
+            requested = int(f.read().strip())
+    except Exception as e:
+        return num_processes
+    if requested < 1:
+        print('# WARNING: {} requests {} env workers, ignored'.format(path, requested))
+        return num_processes
+    return requested
+
+def get_num_cores():
+    '''cores this process may run on'''
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count()
+
+def plan_torch_threads(args, num_env_workers):
+    '''set the intra-op and inter-op threads of torch for args.device. On cuda
+    torch only launches kernels from the main process, so it keeps a single
+    thread. On cpu the cores are shared with the num_env_workers busy env
+    workers: each keeps a core and torch gets the rest, with a quarter of them
+    for inter-op parallelism. --num-torch-threads and
+    --num-torch-interop-threads override the plan'''
+    num_cores = get_num_cores()
+    if torch.device(args.device).type in ['cpu']:
+        num_threads = max(1, num_cores-num_env_workers)
+        num_interop_threads = max(1, num_threads//4)
+    else:
+        num_threads = 1
+        num_interop_threads = 1
+    if args.num_torch_threads is not None:
+        num_threads = args.num_torch_threads
+    if args.num_torch_interop_threads is not None:
+        num_interop_threads = args.num_torch_interop_threads
+
+    torch.set_num_threads(num_threads)
+    if num_interop_threads != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError as e:
+            '''can only be set once, before any inter-op parallel work'''
+            print('# WARNING: inter-op threads of torch not set: {}'.format(e))
+            num_interop_threads = torch.get_num_interop_threads()
+    print('# INFO: [device {}] [cores {}] [env workers {}] [torch threads {}] [torch inter-op threads {}]'.format(
+        args.device, num_cores, num_env_workers, num_threads, num_interop_threads,
+    ))
+
+def get_num_env_workers(args, num_processes):
+    '''processes (or threads) of make_vec_envs that step envs while torch runs'''
+    if args.replay_trajectory_dir is not None:
+        num_env_workers = 0
+    elif args.vec_env in ['thread']:
+        num_env_workers = min(num_processes, get_num_cores())
+    else:
+        num_env_workers = int(np.ceil(num_processes/args.num_envs_per_worker))
+    if args.async_eval:
+        num_env_workers += 1
+    return num_env_workers
+
 def update_linear_schedule(optimizer, epoch, total_num_epochs, initial_lr):
     """Decreases the learning rate linearly"""
     lr = initial_lr - (initial_lr * (epoch / float(total_num_epochs)))
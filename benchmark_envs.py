@@ -0,0 +1,186 @@
+'''measure the throughput of make_vec_envs apart from the learner, by
+driving it with random actions over a sweep of num_processes and vec env
+backends, and break the time of a step down into
+    worker: stepping an env (measured on an env in the main process),
+    ipc: what the backend adds on top of worker (pipes, pickling, threads),
+    wrappers: VecEpisodeStats and VecNormalize,
+    vec_pytorch: numpy to torch conversion of VecPyTorch,
+    frame_stack: VecPyTorchFrameStack'''
+
+import os
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from a2c_ppo_acktr.envs import make_env, make_vec_envs, VecPyTorchFrameStack
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument('--env-name', type=str, default='PongNoFrameskip-v4')
+parser.add_argument('--num-processes', type=int, nargs='*', default=[1, 2, 4, 8, 16, 32])
+parser.add_argument('--vec-envs', type=str, nargs='*', default=['subproc', 'thread'])
+parser.add_argument('--num-envs-per-worker', type=int, default=1)
+parser.add_argument('--fused-preprocess', action='store_true', default=False)
+parser.add_argument('--num-steps', type=int, default=500,
+                    help='steps timed for each point of the sweep')
+parser.add_argument('--num-warmup-steps', type=int, default=50,
+                    help='steps run before timing for each point of the sweep')
+parser.add_argument('--cuda', action='store_true', default=False)
+parser.add_argument('--save-dir', type=str, default='../results/benchmark_envs')
+
+args = parser.parse_args()
+
+device = torch.device('cuda:0' if args.cuda else 'cpu')
+
+STAGES = ['worker', 'ipc', 'wrappers', 'vec_pytorch', 'frame_stack']
+
+def time_step_wait(venv, timings, name):
+    '''accumulate the time spent in (and under) venv.step_wait into timings[name]'''
+    step_wait = venv.step_wait
+    def timed_step_wait():
+        time_start = time.time()
+        results = step_wait()
+        timings[name] += time.time()-time_start
+        return results
+    venv.step_wait = timed_step_wait
+
+def get_worker_step_time():
+    '''time of a step of a single env, without any vec env around it'''
+    env = make_env(args.env_name, 0, 0, None, False, True, None, args.fused_preprocess)()
+    env.reset()
+    for i in range(args.num_warmup_steps+args.num_steps):
+        if i == args.num_warmup_steps:
+            time_start = time.time()
+        _, _, done, _ = env.step(env.action_space.sample())
+        if done:
+            env.reset()
+    step_time = (time.time()-time_start)/args.num_steps
+    env.close()
+    return step_time
+
+def benchmark(num_processes, vec_env, worker_step_time):
+    envs = make_vec_envs(
+        env_name = args.env_name,
+        seed = 0,
+        num_processes = num_processes,
+        gamma = None,
+        log_dir = None,
+        add_timestep = False,
+        device = device,
+        allow_early_resets = True,
+        crop_obs = None,
+        num_envs_per_worker = args.num_envs_per_worker,
+        fused_preprocess = args.fused_preprocess,
+        vec_env = vec_env,
+    )
+
+    '''envs is VecPyTorchFrameStack(VecPyTorch(VecEpisodeStats(raw))) for pixel envs'''
+    assert isinstance(envs, VecPyTorchFrameStack), 'benchmark_envs.py supports pixel envs only'
+    raw = envs
+    while hasattr(raw, 'venv'):
+        raw = raw.venv
+    timings = {'frame_stack': 0.0, 'vec_pytorch': 0.0, 'wrappers': 0.0, 'raw': 0.0}
+    time_step_wait(envs, timings, 'frame_stack')
+    time_step_wait(envs.venv, timings, 'vec_pytorch')
+    time_step_wait(envs.venv.venv, timings, 'wrappers')
+    time_step_wait(raw, timings, 'raw')
+
+    action = torch.LongTensor(num_processes, 1)
+    envs.reset()
+    for i in range(args.num_warmup_steps+args.num_steps):
+        if i == args.num_warmup_steps:
+            for name in timings.keys():
+                timings[name] = 0.0
+            time_start = time.time()
+        action.random_(0, envs.action_space.n)
+        envs.step(action.to(device))
+    total_time = (time.time()-time_start)/args.num_steps
+    envs.close()
+
+    for name in timings.keys():
+        timings[name] /= args.num_steps
+
+    '''each worker steps its num_envs_per_worker envs in a loop'''
+    if (vec_env in ['subproc']) and (num_processes > 1):
+        worker_time = worker_step_time*args.num_envs_per_worker
+    else:
+        worker_time = worker_step_time
+    worker_time = min(worker_time, timings['raw'])
+
+    return {
+        'fps': num_processes/total_time,
+        'total': total_time,
+        'worker': worker_time,
+        'ipc': timings['raw']-worker_time,
+        'wrappers': timings['wrappers']-timings['raw'],
+        'vec_pytorch': timings['vec_pytorch']-timings['wrappers'],
+        'frame_stack': timings['frame_stack']-timings['vec_pytorch'],
+    }
+
+def plot(results):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(1, 1+len(args.vec_envs), figsize=(6*(1+len(args.vec_envs)), 4))
+    for vec_env in args.vec_envs:
+        axes[0].plot(args.num_processes, [results[vec_env][n]['fps'] for n in args.num_processes], marker='o', label=vec_env)
+    axes[0].set_xlabel('num_processes')
+    axes[0].set_ylabel('frames per second')
+    axes[0].set_title(args.env_name)
+    axes[0].legend()
+
+    for ax, vec_env in zip(axes[1:], args.vec_envs):
+        bottom = np.zeros(len(args.num_processes))
+        for stage in STAGES:
+            stage_time = np.array([results[vec_env][n][stage] for n in args.num_processes])*1000.0
+            ax.bar([str(n) for n in args.num_processes], stage_time, bottom=bottom, label=stage)
+            bottom += stage_time
+        ax.set_xlabel('num_processes')
+        ax.set_ylabel('ms per step')
+        ax.set_title(vec_env)
+        ax.legend()
+
+    fig.tight_layout()
+    fig.savefig(os.path.join(args.save_dir, '{}.png'.format(args.env_name)))
+    plt.close(fig)
+
+def main():
+    try:
+        os.makedirs(args.save_dir)
+    except OSError:
+        pass
+
+    worker_step_time = get_worker_step_time()
+    print('# INFO: a step of {} costs {:.3f}ms in the main process'.format(args.env_name, worker_step_time*1000.0))
+
+    results = {}
+    lines = ['vec_env,num_processes,fps,total,{}'.format(','.join(STAGES))]
+    for vec_env in args.vec_envs:
+        results[vec_env] = {}
+        for num_processes in args.num_processes:
+            result = benchmark(num_processes, vec_env, worker_step_time)
+            results[vec_env][num_processes] = result
+            print('# INFO: [{}][P-{}][FPS {}] {}'.format(
+                vec_env,
+                num_processes,
+                int(result['fps']),
+                ' '.join(['[{} {:.3f}ms]'.format(stage, result[stage]*1000.0) for stage in STAGES]),
+            ))
+            lines += ['{},{},{:.2f},{:.6f},{}'.format(
+                vec_env,
+                num_processes,
+                result['fps'],
+                result['total'],
+                ','.join(['{:.6f}'.format(result[stage]) for stage in STAGES]),
+            )]
+
+    with open(os.path.join(args.save_dir, '{}.csv'.format(args.env_name)), 'w') as f:
+        f.write('\n'.join(lines)+'\n')
+    plot(results)
+    print('# INFO: results saved to {}'.format(args.save_dir))
+
+if __name__ == "__main__":
+    main()
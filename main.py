@@ -1,3 +1,4 @@
+import atexit
 import copy
 import glob
 import os
@@ -13,72 +14,82 @@ import torch.optim as optim
 
 from a2c_ppo_acktr import algo
 from a2c_ppo_acktr.arguments import get_args
-from a2c_ppo_acktr.envs import make_vec_envs
+from a2c_ppo_acktr.envs import make_vec_envs, VecEnvPool, get_ready_ids, get_vec_episode_stats, get_replay_actions
 from a2c_ppo_acktr.model import Policy
 from a2c_ppo_acktr.storage import RolloutStorage
-from a2c_ppo_acktr.utils import get_vec_normalize, update_linear_schedule, store_learner, restore_learner, DirectControlMask, VideoSummary, clear_print
+from a2c_ppo_acktr.utils import get_vec_normalize, update_linear_schedule, store_learner, restore_learner, restore_num_trained_frames, DirectControlMask, VideoSummary, clear_print
 from a2c_ppo_acktr.visualize import visdom_plot
-from a2c_ppo_acktr.utils import TF_Summary, VideoSummary, GridImg, ObsNorm
+from a2c_ppo_acktr.utils import TF_Summary, VideoSummary, GridImg, ObsNorm, get_obs_norm_cache_key, evaluate_episodes, AsyncEvaluator, read_num_processes
+from a2c_ppo_acktr.utils import plan_torch_threads, get_num_env_workers
 
 import cv2
 import numpy as np
 
-args = get_args()
-
-assert args.algo in ['a2c', 'ppo', 'acktr']
-if args.recurrent_policy:
-    assert args.algo in ['a2c', 'ppo'], \
-        'Recurrent policy is not implemented for ACKTR'
-
-num_updates = int(args.num_env_steps) // args.num_steps // args.num_processes
-
-torch.manual_seed(args.seed)
-torch.cuda.manual_seed_all(args.seed)
-
-if args.cuda and torch.cuda.is_available() and args.cuda_deterministic:
-    torch.backends.cudnn.benchmark = False
-    torch.backends.cudnn.deterministic = True
-
-try:
-    os.makedirs(args.log_dir)
-    print('# WARNING: Dir empty, make new log dir :{}'.format(args.log_dir))
-except OSError:
-    files = glob.glob(os.path.join(args.log_dir, '*.monitor.csv'))
-    for f in files:
-        os.remove(f)
-    print('# INFO: Dir exists {}'.format(args.log_dir))
-
-eval_log_dir = args.log_dir + "/eval"
-
-try:
-    os.makedirs(eval_log_dir)
-except OSError:
-    files = glob.glob(os.path.join(eval_log_dir, '*.monitor.csv'))
-    for f in files:
-        os.remove(f)
-
 def main():
-    torch.set_num_threads(1)
-    device = torch.device("cuda:0" if args.cuda else "cpu")
+    '''before anything is sized by num_processes'''
+    restored_num_trained_frames = restore_num_trained_frames(args)
+    plan_torch_threads(args, get_num_env_workers(args, args.num_processes))
+    device = torch.device(args.device)
 
     summary_dic = {}
 
     ex_raw = []
 
-    def make_envs():
-        return make_vec_envs(args.env_name, args.seed, args.num_processes,
-                            args.gamma, args.log_dir, args.add_timestep, device, False, args.crop_obs)
+    '''ObsNorm, training and evaluate() share worker pools'''
+    env_pool = VecEnvPool(device)
+    '''main only ends by Ctrl+C, the workers are closed on the way out'''
+    atexit.register(env_pool.close)
+
+    def get_make_vec_envs_kwargs(seed, log_dir):
+        return dict(
+            env_name = args.env_name,
+            seed = seed,
+            num_processes = args.num_processes,
+            gamma = args.gamma,
+            log_dir = log_dir,
+            add_timestep = args.add_timestep,
+            allow_early_resets = True,
+            crop_obs = args.crop_obs,
+            num_envs_per_worker = args.num_envs_per_worker,
+            fused_preprocess = args.fused_preprocess,
+            warm_start = args.warm_start,
+            vec_env = args.vec_env,
+        )
+
+    def make_envs(is_training=False):
+        '''the random agent of ObsNorm does not log its episodes, and as log_dir is
+        part of the pool key, its envs are never recycled into training'''
+        make_vec_envs_kwargs = get_make_vec_envs_kwargs(args.seed, args.log_dir if is_training else None)
+        if is_training and (args.async_envs_k is not None):
+            make_vec_envs_kwargs.update(
+                ready_k = min(args.async_envs_k, args.num_processes),
+                ready_timeout = args.async_envs_timeout,
+            )
+        if is_training and (args.record_trajectory_dir is not None):
+            make_vec_envs_kwargs.update(
+                record_dir = args.record_trajectory_dir,
+                record_steps = args.record_trajectory_steps,
+            )
+        if args.replay_trajectory_dir is not None:
+            make_vec_envs_kwargs.update(
+                replay_dir = args.replay_trajectory_dir,
+            )
+        '''training keeps its envs till the end, so free envs it does not match are closed'''
+        return env_pool.acquire(close_other_free=is_training, **make_vec_envs_kwargs)
 
     obs_norm = ObsNorm(
-        envs = make_envs(),
+        make_envs = make_envs,
+        release_envs = env_pool.release,
         num_processes = args.num_processes,
         nsteps = int(10000/args.num_processes),
+        device = device,
+        cache_dir = os.path.join(args.obs_norm_cache_dir, get_obs_norm_cache_key(args)),
     )
     obs_norm.restore(args.log_dir)
     obs_norm.store(args.log_dir)
     args.epsilon = args.epsilon/obs_norm.ob_std
 
-    envs = make_envs()
+    envs = make_envs(is_training=True)
 
     args.obs_size = envs.observation_space.shape[1]
     args.size_grid = int(args.obs_size/args.num_grid)
@@ -89,7 +100,7 @@ def main():
     running_binary_norm = None
     if args.latent_control_intrinsic_reward_type.split('__')[1] in ['binary']:
         from a2c_ppo_acktr.utils import RunningBinaryNorm
-        running_binary_norm = RunningBinaryNorm()
+        running_binary_norm = RunningBinaryNorm(device=device)
         running_binary_norm.restore('{}/running_binary_norm'.format(args.log_dir))
 
     hash_count_bouns = None
@@ -100,6 +111,7 @@ def main():
                 k = int(args.num_grid**2),
                 m = args.hard_hash_m,
                 batch_size = args.num_processes,
+                device = device,
             )
         elif args.hash_type in ['index']:
             from a2c_ppo_acktr.utils import IndexHashCountBouns
@@ -108,6 +120,7 @@ def main():
                 batch_size = args.num_processes,
                 count_data_type = 'double',
                 is_normalize = True,
+                device = device,
             )
         elif args.hash_type in ['sim']:
             from a2c_ppo_acktr.utils import SimHashCountBouns
@@ -115,6 +128,7 @@ def main():
                 D = int(args.num_grid**2),
                 k = args.sim_hash_k,
                 batch_size = args.num_processes,
+                device = device,
             )
         else:
             raise NotImplemented
@@ -145,6 +159,7 @@ def main():
             mode=args.prioritized_replay_buffer_mode,
             init_list = init_list,
             is_remove_inter_episode_transitions = args.is_remove_inter_episode_transitions,
+            device = device,
         )
 
         '''direct_control_model'''
@@ -156,8 +171,13 @@ def main():
             obs_size = args.obs_size,
             model_structure = args.model_structure['DirectControlModel'],
         )
+        if args.pretrained_control_models_dir is not None:
+            direct_control_model.restore(os.path.join(args.pretrained_control_models_dir, 'direct_control_model.pth'))
         direct_control_model.restore(args.log_dir+'/direct_control_model.pth')
         direct_control_model.to(device)
+        direct_control_model.fused_branches = args.fused_branches
+        if args.skip_masked_cells:
+            direct_control_model.set_active_cells(direct_control_mask.get_mask_batch()[0])
 
         '''latent_control_model'''
         if args.intrinsic_reward_type in ['latent']:
@@ -172,8 +192,15 @@ def main():
                 ob_bound = obs_norm.ob_bound,
                 model_structure = args.model_structure['LatentControlModel'],
                 is_action_conditional = args.is_lantent_control_action_conditional,
+                neighborhood_radius = args.latent_control_neighborhood_radius,
             )
             latent_control_model.to(device)
+            latent_control_model.fused_branches = args.fused_branches
+            latent_control_model.checkpoint_rows = args.control_model_checkpoint_rows
+            if args.control_model_memory_budget_mb is not None:
+                latent_control_model.memory_budget = args.control_model_memory_budget_mb*1024**2
+            if args.pretrained_control_models_dir is not None:
+                latent_control_model.restore(os.path.join(args.pretrained_control_models_dir, 'latent_control_model.pth'))
             latent_control_model.restore(args.log_dir+'/latent_control_model.pth')
 
         brain = algo.MEGA(
@@ -187,6 +214,10 @@ def main():
              G_skip = args.G_skip,
              clip_ir = args.clip_ir,
              hash_type = args.hash_type,
+             traced_inference = args.traced_inference,
+             folded_inference = args.folded_inference,
+             quantized_inference = args.quantized_inference,
+             neighborhood_tradeoff_interval = args.neighborhood_tradeoff_interval,
         )
 
         if args.norm_rew:
@@ -212,24 +243,33 @@ def main():
         agent = algo.A2C_ACKTR(actor_critic, args.value_loss_coef,
                                args.entropy_coef, acktr=True)
 
-    rollouts = RolloutStorage(args.num_steps, args.num_processes,
-                        envs.observation_space.shape, envs.action_space,
-                        actor_critic.recurrent_hidden_state_size)
+    def make_rollouts():
+        rollouts = RolloutStorage(args.num_steps, args.num_processes,
+                            envs.observation_space.shape, envs.action_space,
+                            actor_critic.recurrent_hidden_state_size,
+                            index_actions = args.index_actions)
+
+        obs = envs.reset()
+        obs = obs_norm.obs_norm_batch(obs)
+        rollouts.obs[0].copy_(obs)
+        rollouts.to(device)
+        return rollouts
 
-    obs = envs.reset()
-    obs = obs_norm.obs_norm_batch(obs)
-    rollouts.obs[0].copy_(obs)
-    rollouts.to(device)
+    rollouts = make_rollouts()
 
     time_start = time.time()
-    num_trained_frames_start = j * args.num_processes * args.num_steps
+    if restored_num_trained_frames is not None:
+        num_trained_frames_start = restored_num_trained_frames
+    else:
+        num_trained_frames_start = j * args.num_processes * args.num_steps
+    num_trained_frames = num_trained_frames_start
 
     G = None
 
     first_time_update_agent = True
 
     def store_checkpoints():
-        store_learner(args, actor_critic, envs, j)
+        store_learner(args, actor_critic, envs, j, num_trained_frames)
         if 'in' in args.train_with_reward:
             direct_control_model.store(args.log_dir+'/direct_control_model.pth')
             if args.intrinsic_reward_type in ['latent']:
@@ -249,48 +289,98 @@ def main():
         video_summary.summary_a_video(video_length=1000)
 
     def evaluate():
-        eval_envs = make_vec_envs(
-            args.env_name, args.seed + args.num_processes, args.num_processes,
-            args.gamma, eval_log_dir, args.add_timestep, device, True, args.crop_obs)
+        eval_envs = env_pool.acquire(**get_make_vec_envs_kwargs(args.seed + args.num_processes, eval_log_dir))
 
         vec_norm = get_vec_normalize(eval_envs)
         if vec_norm is not None:
             vec_norm.eval()
             vec_norm.ob_rms = get_vec_normalize(envs).ob_rms
 
-        eval_episode_rewards = []
+        eval_ex_raw = evaluate_episodes(eval_envs, actor_critic, obs_norm.obs_norm_batch, args.eval_steps, device)
 
-        obs = eval_envs.reset()
-        obs = obs_norm.obs_norm_batch(obs)
-        eval_recurrent_hidden_states = torch.zeros(args.num_processes,
-                        actor_critic.recurrent_hidden_state_size, device=device)
-        eval_masks = torch.zeros(args.num_processes, 1, device=device)
-
-        while len(eval_episode_rewards) < args.eval_steps:
-            with torch.no_grad():
-                _, action, _, eval_recurrent_hidden_states = actor_critic.act(
-                    obs, eval_recurrent_hidden_states, eval_masks, deterministic=True)
-
-            # Obser reward and next obs
-            obs, reward, done, infos = eval_envs.step(action)
-            obs = obs_norm.obs_norm_batch(obs)
-
-            eval_masks = torch.FloatTensor([[0.0] if done_ else [1.0]
-                                            for done_ in done])
-            for info in infos:
-                if 'episode' in info.keys():
-                    eval_episode_rewards.append(info['episode']['r'])
-                    clear_print("# INFO: [Evaluate {} episodes] [eval_ex_raw: {}]".format(
-                        len(eval_episode_rewards),
-                        eval_episode_rewards[-1],
-                    ))
-
-        eval_envs.close()
-
-        eval_ex_raw = np.mean(eval_episode_rewards)
+        env_pool.release(eval_envs)
 
         return eval_ex_raw
 
+    def act(obs, recurrent_hidden_states, masks, num_trained_frames):
+        # Sample actions
+        with torch.no_grad():
+            value, action, action_log_prob, recurrent_hidden_states = actor_critic.act(
+                    obs,
+                    recurrent_hidden_states,
+                    masks)
+            if ('in' in args.train_with_reward) and (num_trained_frames<args.num_frames_random_act_no_agent_update):
+                action.random_(0, envs.action_space.n)
+            replay_actions = get_replay_actions(envs)
+            if replay_actions is not None:
+                '''take the recorded actions, so that replayed frames follow from them'''
+                action = torch.from_numpy(replay_actions).long().unsqueeze(1).to(action.device)
+                value, action_log_prob, _, recurrent_hidden_states = actor_critic.evaluate_actions(
+                    obs,
+                    recurrent_hidden_states,
+                    masks,
+                    action)
+        return value, action, action_log_prob, recurrent_hidden_states
+
+    def collect_rollouts_async(num_trained_frames):
+        '''act on the envs as they become ready, each env fills its own
+        num_steps slots of rollouts, so that stragglers do not stall the others.
+        Only the extrinsic reward is collected, see --async-envs-k'''
+        env_ids = torch.arange(args.num_processes)
+        pending_value = rollouts.value_preds[0].clone()
+        pending_action = rollouts.actions[0].clone()
+        pending_action_log_prob = rollouts.action_log_probs[0].clone()
+        pending_recurrent_hidden_states = rollouts.recurrent_hidden_states[0].clone()
+
+        while True:
+            obs, recurrent_hidden_states, masks = rollouts.get_async(env_ids)
+            value, action, action_log_prob, recurrent_hidden_states = act(
+                obs = obs,
+                recurrent_hidden_states = recurrent_hidden_states,
+                masks = masks,
+                num_trained_frames = num_trained_frames,
+            )
+            pending_value[env_ids] = value
+            pending_action[env_ids] = action
+            pending_action_log_prob[env_ids] = action_log_prob
+            pending_recurrent_hidden_states[env_ids] = recurrent_hidden_states
+            envs.step_async(action, env_ids.numpy())
+
+            while True:
+                obs, extrinsic_reward, done, infos = envs.step_wait()
+                obs = obs_norm.obs_norm_batch(obs)
+                ready_ids = torch.from_numpy(get_ready_ids(envs))
+
+                ex_raw.extend(get_vec_episode_stats(envs).get_episode_returns())
+
+                masks = torch.FloatTensor([[0.0] if done_ else [1.0]
+                                           for done_ in done]).to(device)
+
+                rollouts.insert_async(
+                    ready_ids, obs,
+                    pending_recurrent_hidden_states[ready_ids],
+                    pending_action[ready_ids],
+                    pending_action_log_prob[ready_ids],
+                    pending_value[ready_ids],
+                    extrinsic_reward, masks,
+                )
+
+                if rollouts.is_full():
+                    return
+                env_ids = ready_ids[rollouts.env_steps[ready_ids]<args.num_steps]
+                if len(env_ids)>0:
+                    break
+
+    evaluator = None
+    if args.async_eval and (args.eval_interval is not None):
+        evaluator = AsyncEvaluator(
+            actor_critic = actor_critic,
+            make_vec_envs_kwargs = get_make_vec_envs_kwargs(args.seed + args.num_processes, eval_log_dir),
+            ob_mean = obs_norm.ob_mean,
+            ob_std = obs_norm.ob_std,
+            eval_steps = args.eval_steps,
+        )
+
     if args.eval:
         eval_ex_raw = evaluate()
         input('# ACTION REQUIRED: Done evaluating, eval_ex_raw {}'.format(
@@ -299,52 +389,89 @@ def main():
 
     while True:
 
-        num_trained_frames = j * args.num_processes * args.num_steps
+        '''grow or shrink the env workers between updates, buffers sized by
+        num_processes are rebatched, replay buffer and counts are kept'''
+        if args.num_processes_file is not None:
+            num_processes = read_num_processes(args.num_processes_file, args.num_processes)
+            if num_processes != args.num_processes:
+                print('# INFO: num_processes {} -> {}'.format(args.num_processes, num_processes))
+                ob_rms = getattr(get_vec_normalize(envs), 'ob_rms', None)
+                '''envs of the old num_processes are not reused, so their workers are closed'''
+                env_pool.discard(envs)
+                args.num_processes = num_processes
+                envs = make_envs(is_training=True)
+                if ob_rms is not None:
+                    get_vec_normalize(envs).ob_rms = ob_rms
+                obs_norm.resize(args.num_processes)
+                direct_control_mask.resize(args.num_processes)
+                if hash_count_bouns is not None:
+                    hash_count_bouns.resize(args.num_processes)
+                if 'in' in args.train_with_reward:
+                    brain.clear_batch_caches()
+                rollouts = make_rollouts()
+                G = None
+                plan_torch_threads(args, get_num_env_workers(args, args.num_processes))
 
         if args.use_linear_lr_decay:
             # decrease learning rate linearly
             if args.algo == "acktr":
                 # use optimizer's learning rate since it's hard-coded in kfac.py
-                update_linear_schedule(agent.optimizer, j, num_updates, agent.optimizer.lr)
+                update_linear_schedule(agent.optimizer, num_trained_frames, num_frames_to_train, agent.optimizer.lr)
             else:
-                update_linear_schedule(agent.optimizer, j, num_updates, args.lr)
+                update_linear_schedule(agent.optimizer, num_trained_frames, num_frames_to_train, args.lr)
 
         if args.algo == 'ppo' and args.use_linear_clip_decay:
-            agent.clip_param = args.clip_param  * (1 - j / float(num_updates))
-
-        for step in range(args.num_steps):
-            # Sample actions
-            with torch.no_grad():
-                value, action, action_log_prob, recurrent_hidden_states = actor_critic.act(
-                        rollouts.obs[step],
-                        rollouts.recurrent_hidden_states[step],
-                        rollouts.masks[step])
-                if ('in' in args.train_with_reward) and (num_trained_frames<args.num_frames_random_act_no_agent_update):
-                    action.random_(0, envs.action_space.n)
+            agent.clip_param = args.clip_param  * (1 - num_trained_frames / float(num_frames_to_train))
+
+        if args.async_envs_k is not None:
+            collect_rollouts_async(num_trained_frames)
+            num_sync_steps = 0
+        else:
+            '''the first action of each update is sampled from the just updated policy'''
+            value, action, action_log_prob, recurrent_hidden_states = act(
+                obs = rollouts.obs[0],
+                recurrent_hidden_states = rollouts.recurrent_hidden_states[0],
+                masks = rollouts.masks[0],
+                num_trained_frames = num_trained_frames,
+            )
+            envs.step_async(action)
+            num_sync_steps = args.num_steps
+
+        for step in range(num_sync_steps):
 
             # Obser reward and next obs
-            obs, extrinsic_reward, done, infos = envs.step(action)
+            obs, extrinsic_reward, done, infos = envs.step_wait()
             obs = obs_norm.obs_norm_batch(obs)
 
-            for info in infos:
-                if 'episode' in info.keys():
-                    ex_raw.append(info['episode']['r'])
+            ex_raw.extend(get_vec_episode_stats(envs).get_episode_returns())
 
             # If done then clean the history of observations.
             masks = torch.FloatTensor([[0.0] if done_ else [1.0]
-                                       for done_ in done]).cuda()
+                                       for done_ in done]).to(device)
             if G is not None:
                 G = G * masks
 
             rollouts.insert_1(action)
 
+            '''the next action only depends on obs, so the env workers are
+            stepped while MEGA computes the intrinsic reward of this step'''
+            is_next_step = (step+1)<num_sync_steps
+            if is_next_step:
+                next_value, next_action, next_action_log_prob, next_recurrent_hidden_states = act(
+                    obs = obs,
+                    recurrent_hidden_states = recurrent_hidden_states,
+                    masks = masks,
+                    num_trained_frames = num_trained_frames,
+                )
+                envs.step_async(next_action)
+
             if args.train_with_reward in ['in', 'ex_in']:
 
                 if step%args.G_skip==0:
                     M, G, delta_uG = brain.generate_direct_and_latent_control_map(
                         last_states = rollouts.obs[step],
                         now_states = obs[:,-1:],
-                        onehot_actions = rollouts.onehot_actions[rollouts.step],
+                        onehot_actions = rollouts.get_control_actions()[rollouts.step],
                         G = G,
                         masks = masks,
                         direct_control_mask = direct_control_mask,
@@ -392,8 +519,8 @@ def main():
                 args = args,
                 last_states = rollouts.obs[step][:1],
                 now_states = obs[:1,-1:],
-                onehot_actions = rollouts.onehot_actions[rollouts.step][:1],
-                latent_control_model = latent_control_model,
+                onehot_actions = rollouts.get_control_actions()[rollouts.step][:1],
+                latent_control_model = brain.get_inference_models()[1] if ('in' in args.train_with_reward) and (not args.quantized_inference) else latent_control_model,
                 direct_control_mask = direct_control_mask,
                 hash_count_bouns = hash_count_bouns,
                 obs_norm = obs_norm,
@@ -408,6 +535,9 @@ def main():
 
             rollouts.insert_2(obs, recurrent_hidden_states, action_log_prob, value, reward, masks)
 
+            if is_next_step:
+                value, action, action_log_prob, recurrent_hidden_states = next_value, next_action, next_action_log_prob, next_recurrent_hidden_states
+
         if args.logging:
             if video_summary.is_summarizing() is False:
                 input('# ACTION REQUIRED: Done logging')
@@ -442,7 +572,7 @@ def main():
             total_steps = rollouts.obs.size()[0]
             pushed = {
                 'states'                      : rollouts.put_process_axis_into_batch_axis(rollouts.obs           [0          :total_steps-args.G_skip         ]),
-                'actions'                     : rollouts.put_process_axis_into_batch_axis(rollouts.onehot_actions[0          :total_steps-args.G_skip         ]),
+                'actions'                     : rollouts.put_process_axis_into_batch_axis(rollouts.get_control_actions()[0          :total_steps-args.G_skip         ]),
                 'next_states'                 : rollouts.put_process_axis_into_batch_axis(rollouts.obs           [1          :total_steps-args.G_skip+1 ,:,-1:]),
             }
             if args.is_remove_inter_episode_transitions:
@@ -497,11 +627,64 @@ def main():
 
         '''eval'''
         if (args.eval_interval is not None and j % args.eval_interval == 0):
-            summary_dic['eval_ex_raw'] = evaluate()
+            if evaluator is not None:
+                evaluator.submit(actor_critic, num_trained_frames)
+            else:
+                summary_dic['eval_ex_raw'] = evaluate()
+
+        if evaluator is not None:
+            for eval_num_trained_frames, eval_ex_raw in evaluator.get_results():
+                tf_summary.summary_and_flush(
+                    summay_dic = {'eval_ex_raw': eval_ex_raw},
+                    step = eval_num_trained_frames,
+                )
+                clear_print('# INFO: [Evaluated F-{}] [eval_ex_raw: {}]'.format(
+                    eval_num_trained_frames,
+                    eval_ex_raw,
+                ))
 
         j += 1
-        if j == num_updates:
+        num_trained_frames += args.num_processes * args.num_steps
+        if num_trained_frames >= num_frames_to_train:
             input('# ACRION REQUIRED: Run over, press Ctrl+C to release.')
 
 if __name__ == "__main__":
+    '''kept out of module level, since warm env workers re-import this file as __mp_main__,
+    and must neither parse args nor clear the monitor files of the running pools'''
+    args = get_args()
+
+    assert args.algo in ['a2c', 'ppo', 'acktr']
+    if args.recurrent_policy:
+        assert args.algo in ['a2c', 'ppo'], \
+            'Recurrent policy is not implemented for ACKTR'
+
+    num_updates = int(args.num_env_steps) // args.num_steps // args.num_processes
+    '''num_processes may change during training, so progress is measured in frames'''
+    num_frames_to_train = num_updates * args.num_steps * args.num_processes
+
+    torch.manual_seed(args.seed)
+    torch.cuda.manual_seed_all(args.seed)
+
+    if args.cuda and torch.cuda.is_available() and args.cuda_deterministic:
+        torch.backends.cudnn.benchmark = False
+        torch.backends.cudnn.deterministic = True
+
+    try:
+        os.makedirs(args.log_dir)
+        print('# WARNING: Dir empty, make new log dir :{}'.format(args.log_dir))
+    except OSError:
+        files = glob.glob(os.path.join(args.log_dir, '*.monitor.csv'))
+        for f in files:
+            os.remove(f)
+        print('# INFO: Dir exists {}'.format(args.log_dir))
+
+    eval_log_dir = args.log_dir + "/eval"
+
+    try:
+        os.makedirs(eval_log_dir)
+    except OSError:
+        files = glob.glob(os.path.join(eval_log_dir, '*.monitor.csv'))
+        for f in files:
+            os.remove(f)
+
     main()
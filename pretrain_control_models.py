@@ -0,0 +1,177 @@
+'''pretrain DirectControlModel and LatentControlModel offline, on trajectories
+recorded by main.py with --record-trajectory-dir, and store them into
+--pretrained-control-models-dir, which main.py restores them from. Takes the
+same args as main.py, so that the models are built the same way, e.g.
+    python pretrain_control_models.py --env-name PongNoFrameskip-v4 --train-with-reward in \
+        --pretrain-trajectory-dirs ../results/trajectories/Pong-0 ../results/trajectories/Pong-1 \
+        --pretrained-control-models-dir ../results/pretrained/Pong
+    python main.py --env-name PongNoFrameskip-v4 --train-with-reward in \
+        --pretrained-control-models-dir ../results/pretrained/Pong --num-bootup-updates 20'''
+
+import os
+import json
+import time
+
+import torch
+
+from a2c_ppo_acktr import algo
+from a2c_ppo_acktr.arguments import get_args
+from a2c_ppo_acktr.envs import make_vec_envs
+from a2c_ppo_acktr.model import DirectControlModel, LatentControlModel
+from a2c_ppo_acktr.storage import TrajectoryTransitionDataset
+from a2c_ppo_acktr.utils import ObsNorm, get_obs_norm_cache_key, clear_print, plan_torch_threads
+
+args = get_args()
+
+assert 'in' in args.train_with_reward, 'control models are only used with --train-with-reward in or ex_in'
+assert len(args.pretrain_trajectory_dirs)>0, 'no --pretrain-trajectory-dirs given'
+assert args.pretrained_control_models_dir is not None, 'no --pretrained-control-models-dir given'
+
+torch.manual_seed(args.seed)
+torch.cuda.manual_seed_all(args.seed)
+
+def main():
+    '''trajectories are replayed, no env workers'''
+    plan_torch_threads(args, 0)
+    device = torch.device(args.device)
+
+    try:
+        os.makedirs(args.pretrained_control_models_dir)
+    except OSError:
+        pass
+
+    '''replay as many envs as the first trajectory has recorded, which may differ from --num-processes'''
+    with open(os.path.join(args.pretrain_trajectory_dirs[0], 'meta.json'), 'r') as f:
+        num_processes = json.load(f)['num_processes']
+
+    '''estimated on the recorded frames if it is not cached'''
+    def make_envs():
+        return make_vec_envs(
+            env_name = args.env_name,
+            seed = args.seed,
+            num_processes = num_processes,
+            gamma = args.gamma,
+            log_dir = None,
+            add_timestep = args.add_timestep,
+            device = device,
+            allow_early_resets = True,
+            crop_obs = args.crop_obs,
+            replay_dir = args.pretrain_trajectory_dirs[0],
+        )
+    obs_norm = ObsNorm(
+        make_envs = make_envs,
+        num_processes = num_processes,
+        nsteps = int(10000/num_processes),
+        device = device,
+        cache_dir = os.path.join(args.obs_norm_cache_dir, get_obs_norm_cache_key(args)),
+    )
+    obs_norm.restore(args.log_dir)
+    args.epsilon = args.epsilon/obs_norm.ob_std
+    ob_mean = obs_norm.ob_mean[:1]
+
+    envs = make_envs()
+    num_stack = envs.observation_space.shape[0]
+    action_space_n = envs.action_space.n
+    args.obs_size = envs.observation_space.shape[1]
+    envs.close()
+
+    dataset = TrajectoryTransitionDataset(
+        trajectory_dirs = args.pretrain_trajectory_dirs,
+        num_stack = num_stack,
+        G_skip = args.G_skip,
+        is_remove_inter_episode_transitions = args.is_remove_inter_episode_transitions,
+    )
+    data_loader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size = args.pretrain_batch_size,
+        shuffle = True,
+        num_workers = args.pretrain_num_workers,
+        pin_memory = args.cuda,
+        drop_last = True,
+    )
+    print('# INFO: {} transitions from {} trajectories'.format(len(dataset), len(args.pretrain_trajectory_dirs)))
+
+    direct_control_model_path = os.path.join(args.pretrained_control_models_dir, 'direct_control_model.pth')
+    latent_control_model_path = os.path.join(args.pretrained_control_models_dir, 'latent_control_model.pth')
+
+    direct_control_model = DirectControlModel(
+        num_grid = args.num_grid,
+        num_stack = num_stack,
+        action_space_n = action_space_n,
+        obs_size = args.obs_size,
+        model_structure = args.model_structure['DirectControlModel'],
+    )
+    direct_control_model.restore(direct_control_model_path)
+    direct_control_model.to(device)
+    direct_control_model.fused_branches = args.fused_branches
+
+    latent_control_model = None
+    if args.intrinsic_reward_type in ['latent']:
+        latent_control_model = LatentControlModel(
+            num_grid = args.num_grid,
+            num_stack = num_stack,
+            action_space_n = action_space_n,
+            obs_size = args.obs_size,
+            random_noise_frame = args.random_noise_frame,
+            epsilon = args.epsilon,
+            ob_bound = obs_norm.ob_bound,
+            model_structure = args.model_structure['LatentControlModel'],
+            is_action_conditional = args.is_lantent_control_action_conditional,
+            neighborhood_radius = args.latent_control_neighborhood_radius,
+        )
+        latent_control_model.to(device)
+        latent_control_model.fused_branches = args.fused_branches
+        latent_control_model.checkpoint_rows = args.control_model_checkpoint_rows
+        if args.control_model_memory_budget_mb is not None:
+            latent_control_model.memory_budget = args.control_model_memory_budget_mb*1024**2
+        latent_control_model.restore(latent_control_model_path)
+
+    brain = algo.MEGA(
+         direct_control_model = direct_control_model,
+         latent_control_model = latent_control_model,
+         num_iterations = args.num_nobootup_iterations,
+         mini_batch_size = args.pretrain_batch_size,
+         latent_control_discount = args.latent_control_discount,
+         latent_control_intrinsic_reward_type = args.latent_control_intrinsic_reward_type,
+         empty_value = 0.0,
+         G_skip = args.G_skip,
+         clip_ir = args.clip_ir,
+         hash_type = args.hash_type,
+    )
+
+    def obs_norm_batch(x):
+        '''transitions are batched by pretrain_batch_size rather than num_processes'''
+        return (x.to(device, non_blocking=True).float()-ob_mean)/obs_norm.ob_std
+
+    time_start = time.time()
+    num_trained_transitions = 0
+    for epoch in range(args.pretrain_epochs):
+        for i, transitions in enumerate(data_loader):
+            sampled = {
+                'states'      : obs_norm_batch(transitions['states']),
+                'next_states' : obs_norm_batch(transitions['next_states']),
+                'actions'     : transitions['actions'].to(device, non_blocking=True),
+            }
+            if not args.index_actions:
+                sampled['actions'] = torch.zeros(args.pretrain_batch_size, action_space_n, device=device).scatter_(
+                    1, sampled['actions'], 1.0)
+            if args.G_skip>1:
+                sampled['skipped_next_states'] = obs_norm_batch(transitions['skipped_next_states'])
+
+            epoch_loss, _ = brain.update_batch(sampled)
+            num_trained_transitions += args.pretrain_batch_size
+
+            if i % args.log_interval == 0:
+                clear_print('# INFO: [Epoch {}/{}][B-{}/{}][TPS {}] {}'.format(
+                    epoch, args.pretrain_epochs,
+                    i, len(data_loader),
+                    int(num_trained_transitions/(time.time()-time_start)),
+                    ' '.join(['[{} {:.4f}]'.format(name, loss.item()) for name, loss in epoch_loss.items()]),
+                ))
+
+        direct_control_model.store(direct_control_model_path)
+        if latent_control_model is not None:
+            latent_control_model.store(latent_control_model_path)
+
+if __name__ == "__main__":
+    main()
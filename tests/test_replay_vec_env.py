@@ -0,0 +1,78 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+gym = pytest.importorskip('gym')
+pytest.importorskip('baselines')
+
+from baselines.common.vec_env import VecEnv
+
+from a2c_ppo_acktr.envs import make_vec_envs, get_replay_actions, VecTrajectoryRecorder
+
+NUM_PROCESSES = 2
+NUM_STEPS = 5
+OBS_SHAPE = (1, 84, 84)
+ACTION_SPACE_N = 4
+
+
+class RandomFrameVecEnv(VecEnv):
+    '''random uint8 frames standing in for the emulators, to record from'''
+    def __init__(self):
+        VecEnv.__init__(self, NUM_PROCESSES,
+            gym.spaces.Box(low=0, high=255, shape=OBS_SHAPE, dtype=np.uint8),
+            gym.spaces.Discrete(ACTION_SPACE_N))
+        self.rng = np.random.RandomState(0)
+
+    def get_frames(self):
+        return self.rng.randint(0, 256, size=(NUM_PROCESSES,)+OBS_SHAPE).astype(np.uint8)
+
+    def reset(self):
+        return self.get_frames()
+
+    def step_async(self, actions):
+        pass
+
+    def step_wait(self):
+        return self.get_frames(), np.ones(NUM_PROCESSES, dtype=np.float32), np.zeros(NUM_PROCESSES, dtype=bool), [{} for _ in range(NUM_PROCESSES)]
+
+
+@pytest.fixture
+def recorded_dir(tmp_path):
+    record_dir = str(tmp_path / 'trajectory')
+    envs = VecTrajectoryRecorder(RandomFrameVecEnv(), record_dir, NUM_STEPS, 'PongNoFrameskip-v4')
+    envs.reset()
+    for step in range(NUM_STEPS):
+        envs.step_async(np.full(NUM_PROCESSES, step%ACTION_SPACE_N))
+        envs.step_wait()
+    envs.close()
+    return record_dir
+
+
+def test_make_vec_envs_replays_recorded_trajectory(recorded_dir):
+    envs = make_vec_envs(
+        env_name = 'PongNoFrameskip-v4',
+        seed = 1,
+        num_processes = NUM_PROCESSES,
+        gamma = None,
+        log_dir = None,
+        add_timestep = False,
+        device = torch.device('cpu'),
+        allow_early_resets = True,
+        crop_obs = None,
+        replay_dir = recorded_dir,
+    )
+    frames = np.load('{}/frames.npy'.format(recorded_dir))
+    actions = np.load('{}/actions.npy'.format(recorded_dir))
+
+    assert envs.action_space.n == ACTION_SPACE_N
+    obs = envs.reset()
+    assert tuple(obs.size()) == (NUM_PROCESSES, 4)+OBS_SHAPE[1:]
+    assert np.array_equal(obs[:,-1].numpy(), frames[0,:,0])
+
+    for step in range(NUM_STEPS):
+        replay_actions = get_replay_actions(envs)
+        assert np.array_equal(replay_actions, actions[step])
+        obs, reward, done, infos = envs.step(torch.from_numpy(replay_actions).long().unsqueeze(1))
+        assert np.array_equal(obs[:,-1].numpy(), frames[(step+1)%NUM_STEPS,:,0])
+        assert torch.equal(reward, torch.ones(NUM_PROCESSES, 1))
+    envs.close()